@@ -6,7 +6,7 @@
 # These are modified codes from Part 3 for training the agent
 from game import Directions, Agent, Actions
 from captureAgents import CaptureAgent
-import random,util,time,distanceCalculator 
+import random,util,time,sys,distanceCalculator 
 
 def createTeam(firstIndex, secondIndex, isRed,
                numTraining = 0,first = 'RLAgent', second = 'RLAgent'):
@@ -75,6 +75,8 @@ class RLAgent(CaptureAgent):
         self.start = gameState.getAgentPosition(self.index)
         CaptureAgent.registerInitialState(self,gameState)
         print("registering intial state")
+        # Distances to the nearest food, kept up to date by closestFood
+        self.foodField = distanceCalculator.DistanceField(gameState.getWalls())
 
 
         # register weight here
@@ -247,7 +249,7 @@ class RLAgent(CaptureAgent):
         rfood = state.getRedFood()
         bfood = state.getBlueFood()
         x,y = state.getAgentPosition(index)
-        distToFood = closestFood((x,y),bfood,wall)
+        distToFood = closestFood((x,y),bfood,wall,self.foodField)
 
         agentState = state.getAgentState(self.index).copy()
         
@@ -346,24 +348,22 @@ class RLAgent(CaptureAgent):
             print '%s\n%s' % (msg,'-' * len(msg))
 
 ## Redefine this for efficiency
-def closestFood(pos, food, walls):
+def closestFood(pos, food, walls, field=None):
     """
     closestFood -- this method is defined in the reinforcement learning 
     project provided by Berkeley
+
+    It used to run a BFS from pos on every call.  Now the distances to the
+    nearest food are kept in a DistanceField, which only updates the cells
+    around the food eaten or dropped since the last call.  Each agent keeps
+    its own field, so agents looking at different food do not keep undoing
+    each other's updates; without one, a field is made for this call.
     """
-    fringe = [(pos[0], pos[1], 0)]
-    expanded = set()
-    while fringe:
-        pos_x, pos_y, dist = fringe.pop(0)
-        if (pos_x, pos_y) in expanded:
-            continue
-        expanded.add((pos_x, pos_y))
-        # if we find a food at this location then exit
-        if food[pos_x][pos_y]:
-            return dist
-        # otherwise spread out from the location to its neighbours
-        nbrs = Actions.getLegalNeighbors((pos_x, pos_y), walls)
-        for nbr_x, nbr_y in nbrs:
-            fringe.append((nbr_x, nbr_y, dist + 1))
+    if field == None:
+        field = distanceCalculator.DistanceField(walls)
+    field.update(food)
+    dist = field.getDistance(pos)
     # no food found
-    return None
+    if dist == sys.maxint:
+        return None
+    return dist
@@ -184,7 +184,7 @@ class MCTSAgent(CaptureAgent):
             features['eatPacman'] = self.getMazeDistance(myPos, enemy.getPosition())
         elif (myPos in enemyPosiblePos):
 
-          minDistance = min([self.getMazeDistance(myPos, ourfood) for ourfood in ourfoods])
+          minDistance = self.distancer.nearest(myPos, ourfoods)[1]
           features['runback'] = minDistance
           features['distanceToFood'] = 0
           features['gost-one-step'] = -100
@@ -206,7 +206,7 @@ class MCTSAgent(CaptureAgent):
     #       features['gost-one-step'] = -100
 
     if len(foods) > 0:
-      minDistance = min([self.getMazeDistance(myPos, food) for food in foods])
+      minDistance = self.distancer.nearest(myPos, foods)[1]
       features['distanceToFood'] = minDistance
 
     # if (nextState.getAgentState(self.index).numCarrying > 0 and self.runbackCheck(nextState) or
@@ -238,10 +238,10 @@ class MCTSAgent(CaptureAgent):
           self.index).numCarrying > 3):
       features['eatfood'] = 0
       if len(Capsules) > 0:
-        backdistance = min([self.getMazeDistance(myPos, Capsule) for Capsule in Capsules])
+        backdistance = self.distancer.nearest(myPos, Capsules)[1]
         features['runback'] = backdistance * 10000
       else:
-        backdistance = min([self.getMazeDistance(myPos, ourfood) for ourfood in ourfoods])
+        backdistance = self.distancer.nearest(myPos, ourfoods)[1]
         features['runback'] = backdistance
       features['distanceToFood'] = 0
       features['eatfood'] = 0
@@ -271,7 +271,7 @@ class MCTSAgent(CaptureAgent):
     if (self.isPowered()):
       features['isPowered'] = self.powerTimer / POWERCAPSULETIME
       features['eatfood'] = 10 * len(foods)
-      features['distanceToFood'] = 10 * min([self.getMazeDistance(myPos, ourfood) for ourfood in ourfoods])
+      features['distanceToFood'] = 10 * self.distancer.nearest(myPos, ourfoods)[1]
       features['gost-one-step'] = 0
     else:
       features['isPowered'] = 0.0
@@ -329,7 +329,7 @@ class MCTSAgent(CaptureAgent):
         features['eatPacman'] = self.getMazeDistance(myPos, enemy_1.getPosition())
       elif ((not enemy_1.isPacman) and myPos == enemy_1.getPosition()):
         print "run"
-        minDistance = min([self.getMazeDistance(myPos, ourfood) for ourfood in ourfoods])
+        minDistance = self.distancer.nearest(myPos, ourfoods)[1]
         features['runback'] = minDistance
         features['distanceToFood'] = 0
         features['gost-one-step'] = -1
@@ -341,20 +341,20 @@ class MCTSAgent(CaptureAgent):
         features['eatPacman'] = self.getMazeDistance(myPos, enemy_2.getPosition())
       elif ((not enemy_1.isPacman) and myPos == enemy_2.getPosition()):
         print "run"
-        minDistance = min([self.getMazeDistance(myPos, ourfood) for ourfood in ourfoods])
+        minDistance = self.distancer.nearest(myPos, ourfoods)[1]
         features['runback'] = minDistance
         features['distanceToFood'] = 0
         features['gost-one-step'] = -1
 
     if len(foods) > 0:
-      minDistance = min([self.getMazeDistance(myPos, food) for food in foods])
+      minDistance = self.distancer.nearest(myPos, foods)[1]
       features['distanceToFood'] = minDistance
 
     if (nextState.getAgentState(self.index).numCarrying > 2 and self.runbackCheck(nextState) or
             nextState.getAgentState(self.index).numCarrying > 3):
       features['eatfood'] = 0
 
-      backdistance = min([self.getMazeDistance(myPos, ourfood) for ourfood in ourfoods])
+      backdistance = self.distancer.nearest(myPos, ourfoods)[1]
       features['runback'] = backdistance
       features['distanceToFood'] = 0
       features['eatfood'] = 0
@@ -476,7 +476,7 @@ class BAgent(BottomAgent):
         features['eatPacman'] = self.getMazeDistance(myPos, enemy_1.getPosition())
       elif (myPos == enemy_1.getPosition()):
         print "run"
-        minDistance = min([self.getMazeDistance(myPos, ourfood) for ourfood in ourfoods])
+        minDistance = self.distancer.nearest(myPos, ourfoods)[1]
         features['runback'] = minDistance
         features['distanceToFood'] = 0
         features['gost-one-step'] = -1
@@ -488,19 +488,19 @@ class BAgent(BottomAgent):
         features['eatPacman'] = self.getMazeDistance(myPos, enemy_2.getPosition())
       elif (myPos == enemy_2.getPosition()):
         print "run"
-        backdistance = min([self.getMazeDistance(myPos, ourfood) for ourfood in ourfoods])
+        backdistance = self.distancer.nearest(myPos, ourfoods)[1]
         features['runback'] = backdistance
         features['distanceToFood'] = 0
         features['gost-one-step'] = -1
 
     if len(foods) > 0:
-      minDistance = min([self.getMazeDistance(myPos, food) for food in bottomfoods])
+      minDistance = self.distancer.nearest(myPos, bottomfoods)[1]
       features['distanceToFood'] = minDistance
 
     if ((nextState.getAgentState(self.index).numCarrying > 1 and self.runbackCheck(nextState)) or
             nextState.getAgentState(self.index).numCarrying > 3):
       features['eatfood'] = 0
-      minDistance = min([self.getMazeDistance(myPos, ourfood) for ourfood in ourbottomfoods])
+      minDistance = self.distancer.nearest(myPos, ourbottomfoods)[1]
       features['runback'] = minDistance
       features['distanceToFood'] = 0
       features['eatfood'] = 0
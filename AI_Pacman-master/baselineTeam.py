@@ -136,18 +136,23 @@ class OffensiveReflexAgent(ReflexCaptureAgent):
   we give you to get an idea of what an offensive agent might look like,
   but it is by no means the best or only way to build an offensive agent.
   """
+  def registerInitialState(self, gameState):
+    ReflexCaptureAgent.registerInitialState(self, gameState)
+    # Distances to the nearest food, synced with each successor's food
+    self.foodField = distanceCalculator.DistanceField(gameState.getWalls(), self.getFood(gameState))
+
   def getFeatures(self, gameState, action):
     features = util.Counter()
     successor = self.getSuccessor(gameState, action)
-    foodList = self.getFood(successor).asList()    
-    features['successorScore'] = -len(foodList)#self.getScore(successor)
+    food = self.getFood(successor)
+    features['successorScore'] = -food.count()#self.getScore(successor)
 
     # Compute distance to the nearest food
 
-    if len(foodList) > 0: # This should always be True,  but better safe than sorry
+    if food.count() > 0: # This should always be True,  but better safe than sorry
       myPos = successor.getAgentState(self.index).getPosition()
-      minDistance = min([self.getMazeDistance(myPos, food) for food in foodList])
-      features['distanceToFood'] = minDistance
+      self.foodField.update(food)
+      features['distanceToFood'] = self.foodField.getDistance(myPos)
     return features
 
   def getWeights(self, gameState, action):
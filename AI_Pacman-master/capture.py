@@ -55,26 +55,56 @@ from game import Actions
 from util import nearestPoint
 from util import manhattanDistance
 from game import Grid
+from game import BitGrid
 from game import Configuration
 from game import Agent
 from game import reconstituteGrid
 import sys, util, types, time, random, imp
+import weakref
+from collections import deque
 import keyboardAgents
 
+try:
+  import numpy
+  _NUMPY_ENABLED = True
+except:
+  _NUMPY_ENABLED = False
+
 # If you change these, you won't affect the server, so you can't cheat
 KILL_POINTS = 0
 SONAR_NOISE_RANGE = 13 # Must be odd
 SONAR_NOISE_VALUES = [i - (SONAR_NOISE_RANGE - 1)/2 for i in range(SONAR_NOISE_RANGE)]
+SONAR_NOISE_OFFSET = (SONAR_NOISE_RANGE - 1)/2
 SIGHT_RANGE = 5 # Manhattan distance
 MIN_FOOD = 2
 TOTAL_FOOD = 60
 
 DUMP_FOOD_ON_DEATH = True # if we have the gameplay element that dumps dots on death
+_DUMP_CELLS = weakref.WeakKeyDictionary() # layout -> {isRed: cells food may be dumped on}
 
 SCARED_TIME = 40
 
+# The chance of each observed minus true distance, SONAR_NOISE_PROBS[diff +
+# SONAR_NOISE_OFFSET].  The emission table P(observed | true) only depends on
+# that difference, so this one row of it covers every true distance.  The
+# entry past the end is 0, for lookups of differences out of range.
+SONAR_NOISE_PROBS = [1.0/SONAR_NOISE_RANGE] * SONAR_NOISE_RANGE + [0]
+if _NUMPY_ENABLED:
+  _SONAR_NOISE_ARRAY = numpy.array(SONAR_NOISE_PROBS)
+
 def noisyDistance(pos1, pos2):
-  return int(util.manhattanDistance(pos1, pos2) + random.choice(SONAR_NOISE_VALUES))
+  # The same draw as random.choice(SONAR_NOISE_VALUES), without the call
+  return int(util.manhattanDistance(pos1, pos2) + SONAR_NOISE_VALUES[int(random.random() * SONAR_NOISE_RANGE)])
+
+def noisyDistances(pos, positions):
+  """
+  The noisy distances from pos to each of positions, drawn in order, so the
+  random numbers used are the same as for noisyDistance on each in turn.
+  """
+  rand = random.random
+  values = SONAR_NOISE_VALUES
+  return [int(abs(pos[0] - other[0]) + abs(pos[1] - other[1]) + values[int(rand() * SONAR_NOISE_RANGE)])
+          for other in positions]
 
 ###################################################
 # YOUR INTERFACE TO THE PACMAN WORLD: A GameState #
@@ -109,18 +139,49 @@ class GameState:
     """
     # Copy current state
     state = GameState(self)
-
-    # Find appropriate rules for the agent
-    AgentRules.applyAction( state, action, agentIndex )
-    AgentRules.checkDeath(state, agentIndex)
-    AgentRules.decrementTimer(state.data.agentStates[agentIndex])
-
-    # Book keeping
-    state.data._agentMoved = agentIndex
-    state.data.score += state.data.scoreChange
-    state.data.timeleft = self.data.timeleft - 1
+    state._advance(agentIndex, action)
     return state
 
+  def applyMove( self, agentIndex, action ):
+    """
+    Applies the action to this state in place, with exactly the outcome of
+    generateSuccessor(agentIndex, action), and returns an undo record.
+    Passing the record to undoMove restores the state, so searches and
+    rollouts can walk the game tree on a single GameState.  Moves must be
+    undone in the reverse order they were applied.
+    """
+    data = self.data
+    agentRecords = [(a.configuration, a.isPacman, a.scaredTimer, a.numCarrying, a.numReturned)
+                    for a in data.agentStates]
+    undo = (agentRecords, data.food, data.capsules, data.score, data.scoreChange,
+            data.timeleft, data._win, data._lose, data._foodEaten, data._foodAdded,
+            data._capsuleEaten, data._agentMoved, data._zobrist, data.redReturned,
+            data.blueReturned, data.redCarrying, data.blueCarrying)
+
+    # Reset the per-move fields the way a freshly copied GameStateData would
+    data.scoreChange = 0
+    data._win = data._lose = False
+    data._foodEaten = data._foodAdded = data._capsuleEaten = data._agentMoved = None
+    try:
+      self._advance(agentIndex, action)
+    except:
+      self.undoMove(undo)
+      raise
+    return undo
+
+  def undoMove( self, undo ):
+    """
+    Restores the state to what it was before the applyMove that returned undo.
+    """
+    data = self.data
+    (agentRecords, data.food, data.capsules, data.score, data.scoreChange,
+     data.timeleft, data._win, data._lose, data._foodEaten, data._foodAdded,
+     data._capsuleEaten, data._agentMoved, data._zobrist, data.redReturned,
+     data.blueReturned, data.redCarrying, data.blueCarrying) = undo
+    for agentState, record in zip(data.agentStates, agentRecords):
+      (agentState.configuration, agentState.isPacman, agentState.scaredTimer,
+       agentState.numCarrying, agentState.numReturned) = record
+
   def getAgentState(self, index):
     return self.data.agentStates[index]
 
@@ -132,7 +193,7 @@ class GameState:
     agentState = self.data.agentStates[index]
     ret = agentState.getPosition()
     if ret:
-      return tuple(int(x) for x in ret)
+      return (int(ret[0]), int(ret[1]))
     return ret
 
   def getNumAgents( self ):
@@ -166,6 +227,25 @@ class GameState:
   def getBlueCapsules(self):
     return halfList(self.data.capsules, self.data.food, red = False)
 
+  def getRedReturned(self):
+    """
+    Returns the number of dots the red team has brought home so far.
+    """
+    return self.data.redReturned
+
+  def getBlueReturned(self):
+    return self.data.blueReturned
+
+  def getRedCarrying(self):
+    """
+    Returns the number of dots red Pacmen are carrying but have not yet
+    brought home.
+    """
+    return self.data.redCarrying
+
+  def getBlueCarrying(self):
+    return self.data.blueCarrying
+
   def getWalls(self):
     """
     Just like getFood but for walls
@@ -217,11 +297,28 @@ class GameState:
 
   def getDistanceProb(self, trueDistance, noisyDistance):
     "Returns the probability of a noisy distance given the true distance"
-    if noisyDistance - trueDistance in SONAR_NOISE_VALUES:
-      return 1.0/SONAR_NOISE_RANGE
+    diff = noisyDistance - trueDistance
+    if -SONAR_NOISE_OFFSET <= diff <= SONAR_NOISE_OFFSET and diff == int(diff):
+      return SONAR_NOISE_PROBS[int(diff) + SONAR_NOISE_OFFSET]
     else:
       return 0
 
+  def getDistanceProbs(self, trueDistances, noisyDistance):
+    """
+    Returns getDistanceProb(d, noisyDistance) for every d in trueDistances,
+    which are whole numbers, such as a row from Distancer.getDistanceRow.
+    With NumPy that is one table lookup for all of them, returned as an
+    array; otherwise it is a list.
+    """
+    if _NUMPY_ENABLED:
+      index = (noisyDistance + SONAR_NOISE_OFFSET) - numpy.asarray(trueDistances, dtype=numpy.intp)
+      index[(index < 0) | (index >= SONAR_NOISE_RANGE)] = SONAR_NOISE_RANGE
+      return _SONAR_NOISE_ARRAY[index]
+    probs = SONAR_NOISE_PROBS
+    last = SONAR_NOISE_RANGE
+    base = noisyDistance + SONAR_NOISE_OFFSET
+    return [probs[base - d] if 0 <= base - d < last else 0 for d in trueDistances]
+
   def getInitialAgentPosition(self, agentIndex):
     "Returns the initial position of an agent."
     return self.data.layout.agentPositions[agentIndex][1]
@@ -243,6 +340,8 @@ class GameState:
     """
     if prevState != None: # Initial state
       self.data = GameStateData(prevState.data)
+      # The capture rules keep the Zobrist key current as they edit the copy
+      self.data._zobrist = prevState.data._zobrist
       self.blueTeam = prevState.blueTeam
       self.redTeam = prevState.redTeam
       self.data.timeleft = prevState.data.timeleft
@@ -253,6 +352,27 @@ class GameState:
       self.data = GameStateData()
       self.agentDistances = []
 
+  def _advance( self, agentIndex, action ):
+    """
+    Applies the rules for one move to this state, which generateSuccessor
+    and applyMove have already prepared.
+    """
+    # Find appropriate rules for the agent
+    AgentRules.applyAction( self, action, agentIndex )
+    AgentRules.checkDeath(self, agentIndex)
+    if self.data.agentStates[agentIndex].scaredTimer > 0:
+      self.data.hashAgent(agentIndex)
+      AgentRules.decrementTimer(self.data.agentStates[agentIndex])
+      self.data.hashAgent(agentIndex)
+
+    # Book keeping
+    self.data._agentMoved = agentIndex
+    if self.data.scoreChange:
+      self.data.hashScore()
+      self.data.score += self.data.scoreChange
+      self.data.hashScore()
+    self.data.timeleft -= 1
+
   def deepCopy( self ):
     state = GameState( self )
     state.data = self.data.deepCopy()
@@ -265,12 +385,30 @@ class GameState:
     return state
 
   def makeObservation(self, index):
-    state = self.deepCopy()
+    """
+    Returns the state as seen by agent index: noisy distances to every agent
+    and no configuration for opponents out of sight.
+
+    The observation shares everything the agent cannot change behind the
+    game's back.  The layout is immutable and the food grid's bits are an
+    immutable int, so an agent editing its food grid only rebinds its own
+    copy.  Only the small per-agent records, capsules and team lists are
+    copied.
+    """
+    state = GameState(self)
+    data = self.data
+    state.data._agentMoved = data._agentMoved
+    state.data._foodEaten = data._foodEaten
+    state.data._foodAdded = data._foodAdded
+    state.data._capsuleEaten = data._capsuleEaten
+    state.blueTeam = self.blueTeam[:]
+    state.redTeam = self.redTeam[:]
+    state.teams = self.teams[:]
 
     # Adds the sonar signal
     pos = state.getAgentPosition(index)
     n = state.getNumAgents()
-    distances = [noisyDistance(pos, state.getAgentPosition(i)) for i in range(n)]
+    distances = noisyDistances(pos, [state.getAgentPosition(i) for i in range(n)])
     state.agentDistances = distances
 
     # Remove states of distant opponents
@@ -287,7 +425,10 @@ class GameState:
       for teammate in team:
         if util.manhattanDistance(enemyPos, state.getAgentPosition(teammate)) <= SIGHT_RANGE:
           seen = True
-      if not seen: state.data.agentStates[enemy].configuration = None
+      if not seen:
+        state.data.hashAgent(enemy)
+        state.data.agentStates[enemy].configuration = None
+        state.data.hashAgent(enemy)
     return state
 
   def __eq__( self, other ):
@@ -330,6 +471,12 @@ class GameState:
 
 def halfGrid(grid, red):
   halfway = grid.width / 2
+  if isinstance(grid, BitGrid):
+    # Columns are contiguous runs of bits, so each half is a single mask
+    redMask = (1 << (halfway * grid.height)) - 1
+    if red: mask = redMask
+    else:   mask = grid._full & ~redMask
+    return BitGrid(grid.width, grid.height, bits=grid._bits & mask)
   halfgrid = Grid(grid.width, grid.height, False)
   if red:    xrange = range(halfway)
   else:       xrange = range(halfway, grid.width)
@@ -365,12 +512,13 @@ class CaptureRules:
   def __init__(self, quiet = False):
     self.quiet = quiet
 
-  def newGame( self, layout, agents, display, length, muteAgents, catchExceptions ):
+  def newGame( self, layout, agents, display, length, muteAgents, catchExceptions, headless=False ):
     initState = GameState()
     initState.initialize( layout, len(agents) )
     starter = random.randint(0,1)
     print('%s team starts' % ['Red', 'Blue'][starter])
-    game = Game(agents, display, self, startingIndex=starter, muteAgents=muteAgents, catchExceptions=catchExceptions)
+    game = Game(agents, display, self, startingIndex=starter, muteAgents=muteAgents,
+                catchExceptions=catchExceptions, headless=headless)
     game.state = initState
     game.length = length
     game.state.data.timeleft = length
@@ -391,16 +539,10 @@ class CaptureRules:
     if state.isOver():
       game.gameOver = True
       if not game.rules.quiet:
-        redCount = 0
-        blueCount = 0
+        redCount = state.data.redReturned
+        blueCount = state.data.blueReturned
         foodToWin = (TOTAL_FOOD/2) - MIN_FOOD
-        for index in range(state.getNumAgents()):
-          agentState = state.data.agentStates[index]
-          if index in state.getRedTeamIndices():
-            redCount += agentState.numReturned
-          else:
-            blueCount += agentState.numReturned
-        
+
         if blueCount >= foodToWin:#state.getRedFood().count() == MIN_FOOD:
           print 'The Blue team has returned at least %d of the opponents\' dots.' % foodToWin
         elif redCount >= foodToWin:#state.getBlueFood().count() == MIN_FOOD:
@@ -422,12 +564,14 @@ class CaptureRules:
     return min(max(0.75 * max(red, blue) + 0.25 * moves, 0.0), 1.0)
 
   def agentCrash(self, game, agentIndex):
+    game.state.data.hashScore()
     if agentIndex % 2 == 0:
       print >>sys.stderr, "Red agent crashed"
       game.state.data.score = -1
     else:
       print >>sys.stderr, "Blue agent crashed"
       game.state.data.score = 1
+    game.state.data.hashScore()
 
   def getMaxTotalTime(self, agentIndex):
     return 900  # Move limits should prevent this from ever happening
@@ -478,7 +622,9 @@ class AgentRules:
     # if agentState.isPacman: speed = 0.5
     vector = Actions.directionToVector( action, speed )
     oldConfig = agentState.configuration
+    state.data.hashAgent(agentIndex)
     agentState.configuration = oldConfig.generateSuccessor( vector )
+    state.data.hashAgent(agentIndex)
 
     # Eat
     next = agentState.configuration.getPosition()
@@ -494,20 +640,25 @@ class AgentRules:
         score = agentState.numCarrying if isRed else -1*agentState.numCarrying
         state.data.scoreChange += score
 
-        agentState.numReturned += agentState.numCarrying
+        numReturned = agentState.numCarrying
+        agentState.numReturned += numReturned
         agentState.numCarrying = 0
+        if isRed:
+          state.data.redReturned += numReturned
+          state.data.redCarrying -= numReturned
+        else:
+          state.data.blueReturned += numReturned
+          state.data.blueCarrying -= numReturned
 
-        redCount = 0
-        blueCount = 0
-        for index in range(state.getNumAgents()):
-          agentState = state.data.agentStates[index]
-          if index in state.getRedTeamIndices():
-            redCount += agentState.numReturned
-          else:
-            blueCount += agentState.numReturned
-        if redCount >= (TOTAL_FOOD/2) - MIN_FOOD or blueCount >= (TOTAL_FOOD/2) - MIN_FOOD:
+        foodToWin = (TOTAL_FOOD/2) - MIN_FOOD
+        if state.data.redReturned >= foodToWin or state.data.blueReturned >= foodToWin:
           state.data._win = True
 
+        # The team scan that used to sit here left agentState bound to the
+        # last agent, and the eating check below has always looked at that
+        # agent.  Keep it so recorded games replay the same way.
+        agentState = state.data.agentStates[-1]
+
 
     if agentState.isPacman and manhattanDistance( nearest, next ) <= 0.9 :
       AgentRules.consume( nearest, state, state.isOnRedTeam(agentIndex) )
@@ -532,12 +683,15 @@ class AgentRules:
       for agent in agents:
         if agent.getPosition() == position:
           agent.numCarrying += 1
+          if isRed: state.data.redCarrying += 1
+          else: state.data.blueCarrying += 1
           break # the above should only be true for one agent...
 
       # do all the score and food grid maintainenace 
       #state.data.scoreChange += score
       state.data.food = state.data.food.copy()
       state.data.food[x][y] = False
+      state.data.hashFood(position)
       state.data._foodEaten = position
       #if (isRed and state.getBlueFood().count() == MIN_FOOD) or (not isRed and state.getRedFood().count() == MIN_FOOD):
       #  state.data._win = True
@@ -546,14 +700,18 @@ class AgentRules:
     if isRed: myCapsules = state.getBlueCapsules()
     else: myCapsules = state.getRedCapsules()
     if( position in myCapsules ):
-      state.data.capsules.remove( position )
+      # Replace rather than edit the list, since applyMove's undo record shares it
+      state.data.capsules = [c for c in state.data.capsules if c != position]
+      state.data.hashCapsule(position)
       state.data._capsuleEaten = position
 
       # Reset all ghosts' scared timers
       if isRed: otherTeam = state.getBlueTeamIndices()
       else: otherTeam = state.getRedTeamIndices()
       for index in otherTeam:
+        state.data.hashAgent(index)
         state.data.agentStates[index].scaredTimer = SCARED_TIME
+        state.data.hashAgent(index)
 
   consume = staticmethod( consume )
 
@@ -588,10 +746,6 @@ class AgentRules:
     scoreDirection = (-1)**(int(isRed) + 1)
     #state.data.scoreChange += scoreDirection * agentState.numCarrying
 
-    def onRightSide(state, x, y):
-      dummyConfig = Configuration((x, y), 'North')
-      return state.isRed(dummyConfig) == isRed
-
     # we have food to dump
     # -- expand out in BFS. Check:
     #   - that it's within the limits
@@ -599,72 +753,71 @@ class AgentRules:
     #   - that no other agents are there
     #   - that no power pellets are there
     #   - that it's on the right side of the grid
-    def allGood(state, x, y):
-      width, height = state.data.layout.width, state.data.layout.height
-      food, walls = state.data.food, state.data.layout.walls
-
-      # bounds check
-      if x >= width or y >= height or x <= 0 or y <= 0:
-        return False
-
-      if walls[x][y]:
-        return False
-      if food[x][y]:
-        return False
-
-      # dots need to be on the side where this agent will be a pacman :P
-      if not onRightSide(state, x, y):
-        return False
-
-      if (x,y) in state.data.capsules:
-        return False
-
-      # loop through agents
-      agentPoses = [state.getAgentPosition(i) for i in range(state.getNumAgents())]
-      if (x,y) in agentPoses:
-        return False
-
-      return True
+    # The first two and the last never change during a game, so they come
+    # from a per-layout table; capsules and agents are fixed during the dump.
+    sideCells = AgentRules.getDumpCells(state.data.layout, isRed)
+    blocked = set(state.data.capsules)
+    blocked.update([state.getAgentPosition(i) for i in range(state.getNumAgents())])
 
     numToDump = agentState.numCarrying
-    state.data.food = state.data.food.copy()
+    state.data.food = food = state.data.food.copy()
     foodAdded = []
 
-    def genSuccessors(x, y):
-      DX = [-1, 0, 1]
-      DY = [-1, 0, 1]
-      return [(x + dx, y + dy) for dx in DX for dy in DY]
-
-    # BFS graph search
-    positionQueue = [agentState.getPosition()]
-    seen = set()
+    # BFS graph search over the 8-connected plane.  A cell is only queued
+    # the first time it is reached; later copies used to be popped and
+    # skipped, so the visiting order is the same as always.  Cells come off
+    # the queue in order of their chessboard distance from the start, so once
+    # that exceeds the board's size every cell on it has been tried.
+    start = agentState.getPosition()
+    startX, startY = int(start[0]), int(start[1])
+    maxReach = max(state.data.layout.width, state.data.layout.height)
+    positionQueue = deque([start])
+    queued = set([start])
     while numToDump > 0:
-      if not len(positionQueue):
+      popped = positionQueue.popleft()
+      x, y = int(popped[0]), int(popped[1])
+      if max(abs(x - startX), abs(y - startY)) > maxReach:
         raise Exception('Exhausted BFS! uh oh')
-      # pop one off, graph check
-      popped = positionQueue.pop(0)
-      if popped in seen:
-        continue
-      seen.add(popped)
-
-      x, y = popped[0], popped[1]
-      x = int(x)
-      y = int(y)
-      if (allGood(state, x, y)):
-        state.data.food[x][y] = True
+
+      if (x, y) in sideCells and not food[x][y] and (x, y) not in blocked:
+        food[x][y] = True
+        state.data.hashFood((x, y))
         foodAdded.append((x, y))
         numToDump -= 1
 
       # generate successors
-      positionQueue = positionQueue + genSuccessors(x, y)
+      for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+          successor = (x + dx, y + dy)
+          if successor not in queued:
+            queued.add(successor)
+            positionQueue.append(successor)
 
     state.data._foodAdded = foodAdded
     # now our agentState is no longer carrying food
+    if state.isOnRedTeam(agentIndex): state.data.redCarrying -= agentState.numCarrying
+    else: state.data.blueCarrying -= agentState.numCarrying
     agentState.numCarrying = 0
     pass
 
   dumpFoodFromDeath = staticmethod(dumpFoodFromDeath)
 
+  def getDumpCells(layout, isRed):
+    """
+    Returns the set of cells on the red (or blue) side of the layout where
+    food dropped by a dying Pacman may land: inside the border and not a wall.
+    """
+    cells = _DUMP_CELLS.get(layout)
+    if cells == None:
+      cells = {True: set(), False: set()}
+      for x in range(1, layout.width):
+        for y in range(1, layout.height):
+          if not layout.walls[x][y]:
+            cells[x < layout.width / 2].add((x, y))
+      _DUMP_CELLS[layout] = cells
+    return cells[isRed]
+  getDumpCells = staticmethod(getDumpCells)
+
   def checkDeath( state, agentIndex):
     agentState = state.data.agentStates[agentIndex]
     if state.isOnRedTeam(agentIndex):
@@ -686,17 +839,21 @@ class AgentRules:
             if state.isOnRedTeam(agentIndex):
               score = -score
             state.data.scoreChange += score
+            state.data.hashAgent(agentIndex)
             agentState.isPacman = False
             agentState.configuration = agentState.start
             agentState.scaredTimer = 0
+            state.data.hashAgent(agentIndex)
           else:
             score = KILL_POINTS
             if state.isOnRedTeam(agentIndex):
               score = -score
             state.data.scoreChange += score
+            state.data.hashAgent(index)
             otherAgentState.isPacman = False
             otherAgentState.configuration = otherAgentState.start
             otherAgentState.scaredTimer = 0
+            state.data.hashAgent(index)
     else: # Agent is a ghost
       for index in otherTeam:
         otherAgentState = state.data.agentStates[index]
@@ -706,23 +863,27 @@ class AgentRules:
         if manhattanDistance( pacPos, agentState.getPosition() ) <= COLLISION_TOLERANCE:
           #award points to the other team for killing Pacmen
           if agentState.scaredTimer <= 0:
-            AgentRules.dumpFoodFromDeath(state, otherAgentState, agentIndex)
+            AgentRules.dumpFoodFromDeath(state, otherAgentState, index)
 
             score = KILL_POINTS
             if not state.isOnRedTeam(agentIndex):
               score = -score
             state.data.scoreChange += score
+            state.data.hashAgent(index)
             otherAgentState.isPacman = False
             otherAgentState.configuration = otherAgentState.start
             otherAgentState.scaredTimer = 0
+            state.data.hashAgent(index)
           else:
             score = KILL_POINTS
             if state.isOnRedTeam(agentIndex):
               score = -score
             state.data.scoreChange += score
+            state.data.hashAgent(agentIndex)
             agentState.isPacman = False
             agentState.configuration = agentState.start
             agentState.scaredTimer = 0
+            state.data.hashAgent(agentIndex)
   checkDeath = staticmethod( checkDeath )
 
   def placeGhost(state, ghostState):
@@ -792,6 +953,8 @@ def readCommand( argv ):
   parser.add_option('-Q', '--super-quiet', action='store_true', dest="super_quiet",
                     help='Same as -q but agent output is also suppressed', default=False)
 
+  parser.add_option('--fast', action='store_true', default=False,
+                    help='Headless simulation: no display, no stdout from games or agents, reports games per second')
   parser.add_option('-z', '--zoom', type='float', dest='zoom',
                     help=default('Zoom in the graphics'), default=1)
   parser.add_option('-i', '--time', type='int', dest='time',
@@ -827,6 +990,9 @@ def readCommand( argv ):
     import textDisplay
     args['display'] = textDisplay.NullGraphics()
     args['muteAgents'] = True
+  elif options.fast:
+    import textDisplay
+    args['display'] = textDisplay.NullGraphics()
   else:
     import captureGraphicsDisplay
     # Hack for agents writing to the display
@@ -855,7 +1021,7 @@ def readCommand( argv ):
   if options.numTraining > 0:
     redArgs['numTraining'] = options.numTraining
     blueArgs['numTraining'] = options.numTraining
-  nokeyboard = options.textgraphics or options.quiet or options.numTraining > 0
+  nokeyboard = options.textgraphics or options.quiet or options.fast or options.numTraining > 0
   print '\nRed team %s with %s:' % (options.red, redArgs)
   redAgents = loadAgents(True, options.red, nokeyboard, redArgs)
   print '\nBlue team %s with %s:' % (options.blue, blueArgs)
@@ -896,6 +1062,7 @@ def readCommand( argv ):
   args['numTraining'] = options.numTraining
   args['record'] = options.record
   args['catchExceptions'] = options.catchExceptions
+  args['fast'] = options.fast
   return args
 
 def randomLayout(seed = None):
@@ -959,7 +1126,7 @@ def replayGame( layout, agents, actions, display, length, redTeamName, blueTeamN
 
     display.finish()
 
-def runGames( layouts, agents, display, length, numGames, record, numTraining, redTeamName, blueTeamName, muteAgents=False, catchExceptions=False ):
+def runGames( layouts, agents, display, length, numGames, record, numTraining, redTeamName, blueTeamName, muteAgents=False, catchExceptions=False, fast=False ):
 
   rules = CaptureRules()
   games = []
@@ -967,32 +1134,49 @@ def runGames( layouts, agents, display, length, numGames, record, numTraining, r
   if numTraining > 0:
     print 'Playing %d training games' % numTraining
 
-  for i in range( numGames ):
-    beQuiet = i < numTraining
-    layout = layouts[i]
-    if beQuiet:
-        # Suppress output and graphics
-        import textDisplay
-        gameDisplay = textDisplay.NullGraphics()
-        rules.quiet = True
-    else:
-        gameDisplay = display
-        rules.quiet = False
-    g = rules.newGame( layout, agents, gameDisplay, length, muteAgents, catchExceptions )
-    g.run()
-    if not beQuiet: games.append(g)
-
-    g.record = None
-    if record:
-      import time, cPickle, game
-      #fname = ('recorded-game-%d' % (i + 1)) +  '-'.join([str(t) for t in time.localtime()[1:6]])
-      #f = file(fname, 'w')
-      components = {'layout': layout, 'agents': [game.Agent() for a in agents], 'actions': g.moveHistory, 'length': length, 'redTeamName': redTeamName, 'blueTeamName':blueTeamName }
-      #f.close()
-      print "recorded"
-      g.record = cPickle.dumps(components)
-      with open('replay-%d'%i,'wb') as f:
-        f.write(g.record)
+  if fast:
+    # Silence stdout once for the whole run rather than around every agent
+    # call; errors and timeouts still reach stderr.
+    import os, time
+    realStdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    startTime = time.time()
+
+  try:
+    for i in range( numGames ):
+      beQuiet = i < numTraining
+      layout = layouts[i]
+      if beQuiet:
+          # Suppress output and graphics
+          import textDisplay
+          gameDisplay = textDisplay.NullGraphics()
+          rules.quiet = True
+      else:
+          gameDisplay = display
+          rules.quiet = fast
+      g = rules.newGame( layout, agents, gameDisplay, length, muteAgents, catchExceptions, headless=fast )
+      g.run()
+      if not beQuiet: games.append(g)
+
+      g.record = None
+      if record:
+        import time, cPickle, game
+        #fname = ('recorded-game-%d' % (i + 1)) +  '-'.join([str(t) for t in time.localtime()[1:6]])
+        #f = file(fname, 'w')
+        components = {'layout': layout, 'agents': [game.Agent() for a in agents], 'actions': g.moveHistory, 'length': length, 'redTeamName': redTeamName, 'blueTeamName':blueTeamName }
+        #f.close()
+        print "recorded"
+        g.record = cPickle.dumps(components)
+        with open('replay-%d'%i,'wb') as f:
+          f.write(g.record)
+  finally:
+    if fast:
+      sys.stdout.close()
+      sys.stdout = realStdout
+
+  if fast:
+    elapsed = time.time() - startTime
+    print 'Played %d games in %.2f seconds (%.2f games/s)' % (numGames, elapsed, numGames / max(elapsed, 1e-9))
 
   if numGames > 1:
     scores = [game.state.data.score for game in games]
@@ -18,6 +18,7 @@
 
 from game import Agent
 import distanceCalculator
+import layoutAnalysis
 from util import nearestPoint
 import util
 
@@ -99,9 +100,12 @@ class CaptureAgent(Agent):
     self.distancer.getDistance(p1, p2)
     """
     self.red = gameState.isOnRedTeam(self.index)
-    self.distancer = distanceCalculator.Distancer(gameState.data.layout)
+    # Shared with every other agent on this layout in the process
+    self.distancer = distanceCalculator.getDistancer(gameState.data.layout)
 
     # comment this out to forgo maze distance computation and use manhattan distances
+    # (on very large layouts they are computed in the background, and
+    # getDistance falls back on manhattan distance until they are ready)
     self.distancer.getMazeDistances()
 
     import __main__
@@ -247,6 +251,14 @@ class CaptureAgent(Agent):
     d = self.distancer.getDistance(pos1, pos2)
     return d
 
+  def getLayoutAnalysis(self, gameState):
+    """
+    Returns the LayoutAnalysis of the maze, which answers questions about
+    dead ends, alleys, articulation points and border entries in constant
+    time.  It is worked out once per layout and shared by all agents.
+    """
+    return layoutAnalysis.getLayoutAnalysis(gameState.data.layout)
+
   def getPreviousObservation(self):
     """
     Returns the GameState object corresponding to the last state this agent saw
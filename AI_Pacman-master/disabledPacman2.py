@@ -643,7 +643,7 @@ class AttackAgent(MCTSAgent):
     # Compute distance to the nearest food
     if len(foodList) > 0: # This should always be True,  but better safe than sorry
       myPos = successor.getAgentState(self.index).getPosition()
-      minDistance = min([self.getMazeDistance(myPos, food) for food in foodList])
+      minDistance = self.distancer.nearest(myPos, foodList)[1]
       features['distanceToFood'] = minDistance
 
     # Compute distance to the nearest ghost
@@ -655,8 +655,7 @@ class AttackAgent(MCTSAgent):
       myPos = successor.getAgentPosition(self.index)
       # myPos = gameState.getAgentPosition(self.index)
       positions = [agent.getPosition() for agent in ghosts]
-      self.target = min(positions, key = lambda x: self.getMazeDistance(myPos, x))
-      self.distanceToGhost = self.getMazeDistance(myPos, self.target)  
+      self.target, self.distanceToGhost = self.distancer.nearest(myPos, positions)
       if self.distanceToGhost < 10:
         features['distanceToGhost'] = self.distanceToGhost
       #print 'Ghost Positions:', positions  # Ghost index: 1, 3
@@ -19,9 +19,22 @@ caches the shortest path between any two points in the maze.
 Example:
 distancer = Distancer(gameState.data.layout)
 distancer.getDistance( (1,1), (10,10) )
+
+Agents share one Distancer per maze through getDistancer(layout).
 """
 
-import sys, time, random
+import sys, time, random, gc
+import os, stat, mmap, struct, hashlib, tempfile, threading
+from array import array
+from collections import OrderedDict
+from game import Grid, BitGrid
+from layout import wallsFingerprint
+
+try:
+  import numpy
+  _NUMPY_ENABLED = True
+except:
+  _NUMPY_ENABLED = False
 
 class Distancer:
   def __init__(self, layout, default = 10000):
@@ -29,18 +42,49 @@ class Distancer:
     Initialize with Distancer(layout).  Changing default is unnecessary.
     """
     self._distances = None
+    # Computes the distances in the background, while _distances is None
+    self._worker = None
     self.default = default
     self.dc = DistanceCalculator(layout, self, default)
 
-  def getMazeDistances(self):
-    self.dc.run()
+  def getMazeDistances(self, background = None, lazy = None, cacheMB = None):
+    """
+    Loads or computes the maze distances.  With background true they are
+    computed in a background thread and getDistance answers with Manhattan
+    distance until the rows it needs are done.  By default that only happens
+    for layouts with more than BACKGROUND_CELLS open cells, so games on the
+    usual layouts stay reproducible.
+
+    With lazy true no matrix is built: the row of a cell is computed the
+    first time a distance from it is asked for, and at most cacheMB
+    megabytes of rows (LAZY_CACHE_MB by default) are kept.  That is the
+    default for layouts with more than LAZY_CELLS open cells, whose whole
+    matrix would not fit in memory.
+
+    A Distancer from getDistancer is shared, so only the first call does
+    anything; later ones find the distances loaded or on their way.
+    """
+    if self._distances != None or self._worker != None:
+      return
+    self.dc.run(background, lazy, cacheMB)
 
   def getDistance(self, pos1, pos2):
     """
     The getDistance function is the only one you'll need after you create the object.
     """
-    if self._distances == None:
-      return manhattanDistance(pos1, pos2)
+    matrix = self._distances
+    if matrix == None:
+      matrix = self._checkWorker()
+      if matrix == None:
+        if self._worker != None:
+          return self._worker.getDistance(pos1, pos2)
+        return manhattanDistance(pos1, pos2)
+    if pos1 in matrix.rowStarts and pos2 in matrix.index:
+      # Both are open grid cells, by far the most common case
+      distance = matrix.lookup(matrix.rowStarts[pos1] + matrix.index[pos2])
+      if distance == UNREACHABLE:
+        return sys.maxint
+      return distance
     if isInt(pos1) and isInt(pos2):
       return self.getDistanceOnGrid(pos1, pos2)
     pos1Grids = getGrids2D(pos1)
@@ -55,14 +99,104 @@ class Distancer:
     return bestDistance
 
   def getDistanceOnGrid(self, pos1, pos2):
-    key = (pos1, pos2)
-    if key in self._distances:
-      return self._distances[key]
+    return self._distances.getDistance(pos1, pos2)
+
+  def getDistances(self, pos, targets):
+    """
+    Returns [getDistance(pos, target) for target in targets], reading them
+    from pos's row of the distance matrix in one go when every position is
+    a grid cell.
+    """
+    targets = list(targets)
+    matrix = self._distances
+    if matrix == None:
+      matrix = self._checkWorker()
+    if matrix == None or pos not in matrix.rowStarts:
+      return [self.getDistance(pos, target) for target in targets]
+    index = matrix.index
+    try:
+      columns = [index[target] for target in targets]
+    except KeyError:
+      return [self.getDistance(pos, target) for target in targets]
+    if _NUMPY_ENABLED:
+      distances = matrix.matrix[matrix.index[pos]].take(columns).tolist()
     else:
-      raise Exception("Positions not in grid: " + str(key))
+      start = matrix.rowStarts[pos]
+      lookup = matrix.lookup
+      distances = [lookup(start + column) for column in columns]
+    if UNREACHABLE in distances:
+      distances = [sys.maxint if d == UNREACHABLE else d for d in distances]
+    return distances
+
+  def nearest(self, pos, targets):
+    """
+    Returns (target, distance) for the target closest to pos, taking the
+    first of any that tie, like min would.
+    """
+    return self.kNearest(pos, targets, 1)[0]
+
+  def kNearest(self, pos, targets, k):
+    """
+    Returns (target, distance) pairs for the k targets closest to pos, nearest
+    first.  Ties keep the order they had in targets.
+    """
+    targets = list(targets)
+    if not targets:
+      raise ValueError('no targets to measure from ' + str(pos))
+    distances = self.getDistances(pos, targets)
+    if k == 1:
+      best = distances.index(min(distances))
+      return [(targets[best], distances[best])]
+    order = sorted(range(len(targets)), key=distances.__getitem__)[:k]
+    return [(targets[i], distances[i]) for i in order]
+
+  def getCacheStats(self):
+    """
+    Returns a dict with the hits, misses, evictions and rows held by the row
+    cache of lazy mode, or None when the distances are not lazy.
+    """
+    if isinstance(self._distances, LazyDistanceRows):
+      return self._distances.getStats()
+    return None
 
   def isReadyForMazeDistance(self):
-    return self._distances != None
+    return self._checkWorker() != None
+
+  def _checkWorker(self):
+    "Takes the background worker's matrix once it is done; returns _distances"
+    worker = self._worker
+    if worker != None and worker.done:
+      self._distances = worker.matrix
+      self._worker = None
+    return self._distances
+
+  def getCells(self):
+    """
+    Returns the open cells of the maze in the order getDistanceRow uses.
+    """
+    return self._getMatrix().cells
+
+  def getCellIndex(self, pos):
+    """
+    Returns the position of cell pos in getCells() and in every distance row.
+    """
+    return self._getMatrix().getIndex(pos)
+
+  def getDistanceRow(self, pos):
+    """
+    Returns the maze distances from grid cell pos to every cell of getCells(),
+    all at once: a read-only NumPy uint16 array if NumPy is available, else an
+    array('H').  Unreachable cells are UNREACHABLE away.
+    """
+    return self._getMatrix().getRow(pos)
+
+  def _getMatrix(self):
+    if self._distances == None and self._worker != None:
+      # Whole rows are wanted, so wait for the rest of them
+      self._worker.thread.join()
+    if self._checkWorker() == None:
+      raise Exception("Maze distances have not been computed; call getMazeDistances first")
+    return self._distances
 
 def manhattanDistance(x, y ):
   return abs( x[0] - y[0] ) + abs( x[1] - y[1] )
@@ -88,7 +222,162 @@ def getGrids1D(x):
 # MACHINERY FOR COMPUTING MAZE DISTANCES #
 ##########################################
 
+# These tables are keyed by getLayoutKey, so layouts with the same walls share
+# their distances
 distanceMap = {}
+lazyDistanceMap = {}
+distancers = {}
+
+def getLayoutKey(layout):
+    "The fingerprint of the layout's walls"
+    try:
+        return layout.fingerprint
+    except AttributeError:
+        # Layouts unpickled from before fingerprints were added
+        return wallsFingerprint(layout.walls)
+
+def getDistancer(layout):
+    """
+    Returns the Distancer shared by every agent in the process that plays on
+    layout's walls, creating it the first time.  Call getMazeDistances on it
+    as usual; once its distances are loaded that returns at once.
+    """
+    key = getLayoutKey(layout)
+    if key not in distancers:
+        distancers[key] = Distancer(layout)
+    return distancers[key]
+
+# Default memory for the rows of LazyDistanceRows, in megabytes
+LAZY_CACHE_MB = 64
+
+# Distance stored for cells that cannot reach each other
+UNREACHABLE = 0xffff
+
+class DistanceMatrix(object):
+  """
+  Maze distances between every pair of open cells of a layout.  They are kept
+  as one flat array of unsigned 16-bit ints, a row per source cell, with a
+  map from cell to index; a dict keyed on pairs of cells would hold V**2
+  tuples.  With NumPy, matrix is an (n, n) view of the same memory.
+
+  data is an array('H') or any buffer, such as an mmap of a cache file,
+  holding the distances from byte offset on.  NumPy reads a buffer in place;
+  without it the distances are copied into an array.
+  """
+  def __init__(self, cells, data, offset = 0):
+    self.cells = cells
+    self.size = n = len(cells)
+    self.index = dict([(cell, i) for i, cell in enumerate(cells)])
+    # Where each cell's row begins in flat
+    self.rowStarts = dict([(cell, i * n) for i, cell in enumerate(cells)])
+    if _NUMPY_ENABLED:
+      self.flat = numpy.frombuffer(data, dtype=numpy.uint16, count=n * n, offset=offset)
+      self.matrix = self.flat.reshape(n, n)
+      self.matrix.flags.writeable = False
+      # item() returns Python ints, which don't wrap around like uint16s
+      self.lookup = self.flat.item
+    else:
+      if not isinstance(data, array):
+        flat = array('H')
+        flat.fromstring(data[offset:offset + 2 * n * n])
+        data = flat
+      self.flat = data
+      self.lookup = data.__getitem__
+
+  def getIndex(self, pos):
+    if pos not in self.index:
+      raise Exception("Position not in grid: " + str(pos))
+    return self.index[pos]
+
+  def getDistance(self, pos1, pos2):
+    if pos1 not in self.rowStarts or pos2 not in self.index:
+      raise Exception("Positions not in grid: " + str((pos1, pos2)))
+    distance = self.lookup(self.rowStarts[pos1] + self.index[pos2])
+    if distance == UNREACHABLE:
+      return sys.maxint
+    return distance
+
+  def getRow(self, pos):
+    i = self.getIndex(pos)
+    if _NUMPY_ENABLED:
+      return self.matrix[i]
+    return self.flat[i * self.size:(i + 1) * self.size]
+
+class LazyDistanceRows(object):
+  """
+  Maze distances computed one source row at a time, on first use, for
+  layouts too big for a DistanceMatrix.  Rows are array('H')s kept in least
+  recently used order and evicted past maxBytes.  Distances are symmetric, so
+  a held row of either cell answers a query.
+
+  It offers the DistanceMatrix methods the Distancer uses.  rowStarts is
+  empty, since there is no flat array, so the Distancer always goes through
+  getDistance.
+  """
+  rowStarts = {}
+
+  def __init__(self, layout, maxBytes):
+    self.cells = layout.walls.asList(False)
+    self.size = n = len(self.cells)
+    self.index = dict([(cell, i) for i, cell in enumerate(self.cells)])
+    self.neighbors = getNeighborIndices(layout.walls, self.cells)
+    # At least one row, or every query would compute one
+    self.maxRows = max(1, maxBytes // (2 * max(n, 1)))
+    self.rows = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def getIndex(self, pos):
+    if pos not in self.index:
+      raise Exception("Position not in grid: " + str(pos))
+    return self.index[pos]
+
+  def getDistance(self, pos1, pos2):
+    if pos1 not in self.index or pos2 not in self.index:
+      raise Exception("Positions not in grid: " + str((pos1, pos2)))
+    i, j = self.index[pos1], self.index[pos2]
+    rows = self.rows
+    if i in rows:
+      distance = self._touch(i)[j]
+    elif j in rows:
+      distance = self._touch(j)[i]
+    else:
+      distance = self._fetch(i)[j]
+    if distance == UNREACHABLE:
+      return sys.maxint
+    return distance
+
+  def getRow(self, pos):
+    row = self._fetch(self.getIndex(pos))
+    if _NUMPY_ENABLED:
+      row = numpy.frombuffer(row, dtype=numpy.uint16)
+      row.flags.writeable = False
+      return row
+    return row[:]
+
+  def getStats(self):
+    return {'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'rows': len(self.rows)}
+
+  def _touch(self, i):
+    "Returns held row i, marking it most recently used"
+    self.hits += 1
+    row = self.rows.pop(i)
+    self.rows[i] = row
+    return row
+
+  def _fetch(self, i):
+    "Returns row i, computing it if it is not held"
+    if i in self.rows:
+      return self._touch(i)
+    self.misses += 1
+    row = array('H', bfsRow(self.neighbors, i))
+    if len(self.rows) >= self.maxRows:
+      self.rows.popitem(last=False)
+      self.evictions += 1
+    self.rows[i] = row
+    return row
 
 class DistanceCalculator:
   def __init__(self, layout, distancer, default = 10000):
@@ -96,58 +385,496 @@ class DistanceCalculator:
     self.distancer = distancer
     self.default = default
 
-  def run(self):
+  def run(self, background = None, lazy = None, cacheMB = None):
     global distanceMap
 
-    if self.layout.walls not in distanceMap:
-      distances = computeDistances(self.layout)
-      distanceMap[self.layout.walls] = distances
+    walls = self.layout.walls
+    key = getLayoutKey(self.layout)
+    if key not in distanceMap:
+      distances = loadCachedMatrix(self.layout)
+      if distances == None:
+        if lazy == None:
+          lazy = walls.count(False) > LAZY_CELLS
+        if lazy:
+          # Every Distancer on these walls shares one row cache
+          if key not in lazyDistanceMap:
+            if cacheMB == None:
+              cacheMB = LAZY_CACHE_MB
+            maxBytes = int(cacheMB * 1024 * 1024)
+            lazyDistanceMap[key] = LazyDistanceRows(self.layout, maxBytes)
+          self.distancer._distances = lazyDistanceMap[key]
+          return
+        if background == None:
+          background = walls.count(False) > BACKGROUND_CELLS
+        if background:
+          # Every Distancer on these walls shares one worker
+          if key not in distanceWorkers:
+            distanceWorkers[key] = DistanceWorker(self.layout)
+          self.distancer._worker = distanceWorkers[key]
+          return
+        distances = computeDistanceMatrix(self.layout)
+        storeCachedMatrix(self.layout, distances)
+      distanceMap[key] = distances
     else:
-      distances = distanceMap[self.layout.walls]
+      distances = distanceMap[key]
 
     self.distancer._distances = distances
 
+# Layouts with more open cells than this compute their distances in the
+# background by default; the largest layouts shipped have about 600
+BACKGROUND_CELLS = 2000
+
+# Layouts with more open cells than this use LazyDistanceRows by default; the
+# matrix of 10000 cells takes 200MB
+LAZY_CELLS = 10000
+
+distanceWorkers = {}
+
+class DistanceWorker(object):
+  """
+  Computes the distance matrix of a layout in a background thread, one
+  source cell's row at a time, publishing each row as soon as it is done.
+  When every row is in, the matrix is added to distanceMap and the disk
+  cache, and done is set.
+  """
+  def __init__(self, layout):
+    self.layout = layout
+    cells = layout.walls.asList(False)
+    self.neighbors = getNeighborIndices(layout.walls, cells)
+    self.size = len(cells)
+    self.data = array('H', [UNREACHABLE]) * (self.size * self.size)
+    self.matrix = DistanceMatrix(cells, self.data)
+    self.rowDone = [False] * self.size
+    self.done = False
+    self.thread = threading.Thread(target=self.run, name='maze distances')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    n = self.size
+    for source in range(n):
+      self.data[source * n:(source + 1) * n] = array('H', bfsRow(self.neighbors, source))
+      self.rowDone[source] = True
+    storeCachedMatrix(self.layout, self.matrix)
+    key = getLayoutKey(self.layout)
+    distanceMap[key] = self.matrix
+    distanceWorkers.pop(key, None)
+    self.done = True
+
+  def getDistance(self, pos1, pos2):
+    """
+    The maze distance if the row of either cell is done, since distances are
+    symmetric, and the Manhattan distance otherwise.
+    """
+    index = self.matrix.index
+    if pos1 in index and pos2 in index:
+      i, j = index[pos1], index[pos2]
+      distance = None
+      if self.rowDone[i]:
+        distance = self.matrix.lookup(i * self.size + j)
+      elif self.rowDone[j]:
+        distance = self.matrix.lookup(j * self.size + i)
+      if distance != None:
+        if distance == UNREACHABLE:
+          return sys.maxint
+        return distance
+    return manhattanDistance(pos1, pos2)
+
 def computeDistances(layout):
-    "Runs UCS to all other positions from each position"
+    """
+    Returns the maze distances of the layout as a dict mapping (target,
+    source) pairs of cells to distances, sys.maxint when unreachable.  The
+    Distancer itself uses the much smaller computeDistanceMatrix.
+    """
+    matrix = computeDistanceMatrix(layout)
+    cells, lookup, n = matrix.cells, matrix.lookup, matrix.size
     distances = {}
-    allNodes = layout.walls.asList(False)
-    for source in allNodes:
-        dist = {}
-        closed = {}
-        for node in allNodes:
-            dist[node] = sys.maxint
-        import util
-        queue = util.PriorityQueue()
-        queue.push(source, 0)
-        dist[source] = 0
-        while not queue.isEmpty():
-            node = queue.pop()
-            if node in closed:
-                continue
-            closed[node] = True
-            nodeDist = dist[node]
-            adjacent = []
-            x, y = node
-            if not layout.isWall((x,y+1)):
-                adjacent.append((x,y+1))
-            if not layout.isWall((x,y-1)):
-                adjacent.append((x,y-1) )
-            if not layout.isWall((x+1,y)):
-                adjacent.append((x+1,y) )
-            if not layout.isWall((x-1,y)):
-                adjacent.append((x-1,y))
-            for other in adjacent:
-                if not other in dist:
-                    continue
-                oldDist = dist[other]
-                newDist = nodeDist+1
-                if newDist < oldDist:
-                    dist[other] = newDist
-                    queue.push(other, newDist)
-        for target in allNodes:
-            distances[(target, source)] = dist[target]
+    # Hundreds of thousands of key tuples would otherwise set off the cyclic
+    # garbage collector over and over, for no garbage at all
+    gcWasEnabled = gc.isenabled()
+    gc.disable()
+    try:
+        for i, source in enumerate(cells):
+            row = [lookup(k) for k in range(i * n, (i + 1) * n)]
+            row = [sys.maxint if d == UNREACHABLE else d for d in row]
+            distances.update(zip([(target, source) for target in cells], row))
+    finally:
+        if gcWasEnabled: gc.enable()
     return distances
 
+def computeDistanceMatrix(layout):
+    "Runs BFS to all other positions from each position"
+    cells, rows = computeDistanceRows(layout)
+    flat = array('H')
+    if _NUMPY_ENABLED:
+        flat.fromstring(rows.tostring())
+    else:
+        for row in rows:
+            flat.fromlist(row)
+    return DistanceMatrix(cells, flat)
+
+def computeDistanceRows(layout):
+    """
+    Returns (cells, rows): the open cells of the layout and, for each one, the
+    maze distances from it to every cell in the same order, UNREACHABLE for
+    cells it cannot reach.  Rows are lists, or one (n, n) uint16 array when
+    NumPy is available.
+
+    Every move costs one, so a breadth-first search from each cell gives the
+    same distances a uniform-cost search would.  With NumPy the searches from
+    all cells advance together, one frontier step at a time.
+    """
+    cells = layout.walls.asList(False)
+    neighbors = getNeighborIndices(layout.walls, cells)
+    if _NUMPY_ENABLED:
+        return cells, _bfsRowsNumpy(neighbors)
+    return cells, [bfsRow(neighbors, source) for source in range(len(cells))]
+
+def getNeighborIndices(walls, cells):
+    "For each cell in cells, the indices of the open cells next to it"
+    index = dict([(cell, i) for i, cell in enumerate(cells)])
+    neighbors = []
+    for x, y in cells:
+        adjacent = [(x, y + 1), (x, y - 1), (x + 1, y), (x - 1, y)]
+        neighbors.append([index[other] for other in adjacent if other in index])
+    return neighbors
+
+def bfsRow(neighbors, source):
+    "Distances from cell index source to every cell, by breadth-first search"
+    dist = [UNREACHABLE] * len(neighbors)
+    dist[source] = 0
+    frontier = [source]
+    depth = 0
+    while frontier:
+        depth += 1
+        nextFrontier = []
+        for node in frontier:
+            for other in neighbors[node]:
+                if dist[other] == UNREACHABLE:
+                    dist[other] = depth
+                    nextFrontier.append(other)
+        frontier = nextFrontier
+    return dist
+
+def _bfsRowsNumpy(neighbors):
+    """
+    All-pairs BFS over boolean matrices.  Row t of reached says which sources
+    have reached cell t so far; each step ORs in the rows of t's neighbors.
+    """
+    n = len(neighbors)
+    # Pad every neighbor list to four entries with a row that is never set
+    padded = numpy.empty((n, 4), dtype=numpy.intp)
+    padded.fill(n)
+    for i, adjacent in enumerate(neighbors):
+        padded[i, :len(adjacent)] = adjacent
+    frontier = numpy.zeros((n + 1, n), dtype=bool)
+    frontier[numpy.arange(n), numpy.arange(n)] = True
+    reached = frontier[:n].copy()
+    dist = numpy.empty((n, n), dtype=numpy.uint16)
+    dist.fill(UNREACHABLE)
+    dist[numpy.arange(n), numpy.arange(n)] = 0
+    depth = 0
+    while True:
+        depth += 1
+        step = frontier[padded[:, 0]]
+        for k in (1, 2, 3):
+            step |= frontier[padded[:, k]]
+        step &= ~reached
+        if not step.any():
+            break
+        reached |= step
+        dist[step] = depth
+        frontier[:n] = step
+    # dist is indexed [target, source], but maze distances are symmetric
+    return dist
+
+##########################################
+# DISTANCES TO THE NEAREST OF A SET      #
+##########################################
+
+class DistanceField(object):
+  """
+  The maze distance from every open cell to the nearest of a set of target
+  cells, such as the food left on one side or the home border.  It is one
+  multi-source BFS, kept up to date as targets are added and removed, so
+  getDistance is a single list lookup however many targets there are.
+
+  update diffs the targets against the ones the field was built for: when
+  both are BitGrids, as food grids are, that is one XOR, so syncing with the
+  food of each new state only touches the cells that were eaten or dropped.
+
+  Example:
+  field = DistanceField(gameState.getWalls(), self.getFood(gameState))
+  field.update(self.getFood(successor))
+  field.getDistance(myPos)
+  """
+  def __init__(self, walls, targets = ()):
+    self.walls = walls
+    self.cells = walls.asList(False)
+    self.index = dict([(cell, i) for i, cell in enumerate(self.cells)])
+    self.neighbors = getNeighborIndices(walls, self.cells)
+    self.height = walls.height
+    self.dist = [UNREACHABLE] * len(self.cells)
+    # The targets as bits, in BitGrid order: cell (x,y) is bit x * height + y
+    self.bits = 0
+    self.update(targets)
+
+  def getDistance(self, pos):
+    """
+    The maze distance from grid cell pos to the nearest target, sys.maxint if
+    no target can be reached.
+    """
+    if pos not in self.index:
+      raise Exception("Position not in grid: " + str(pos))
+    distance = self.dist[self.index[pos]]
+    if distance == UNREACHABLE:
+      return sys.maxint
+    return distance
+
+  def getTargets(self):
+    return [self.cells[i] for i in range(len(self.cells)) if self.dist[i] == 0]
+
+  def update(self, targets):
+    """
+    Makes targets, a Grid or a list of cells, the target set, recomputing
+    only the distances that change.
+    """
+    if isinstance(targets, BitGrid) and targets.height == self.height:
+      self._setBits(targets._bits)
+    else:
+      if isinstance(targets, Grid):
+        targets = targets.asList()
+      self._setBits(self._cellBits(targets))
+
+  def add(self, cells):
+    "Adds cells to the targets"
+    self._setBits(self.bits | self._cellBits(cells))
+
+  def remove(self, cells):
+    "Removes cells from the targets"
+    self._setBits(self.bits & ~self._cellBits(cells))
+
+  def _cellBits(self, cells):
+    bits = 0
+    for x, y in cells:
+      bits |= 1 << (int(x) * self.height + int(y))
+    return bits
+
+  def _setBits(self, bits):
+    changed = self.bits ^ bits
+    if not changed:
+      return
+    added, removed = [], []
+    while changed:
+      low = changed & -changed
+      bit = low.bit_length() - 1
+      cell = (bit // self.height, bit % self.height)
+      if cell in self.index:
+        if bits & low: added.append(self.index[cell])
+        else: removed.append(self.index[cell])
+      changed ^= low
+    self.bits = bits
+    if removed: self._remove(removed)
+    if added: self._add(added)
+
+  def _add(self, sources):
+    dist = self.dist
+    for source in sources:
+      dist[source] = 0
+    self._relax({0: sources})
+
+  def _remove(self, sources):
+    """
+    Distances can only grow, and only at cells that had a shortest path to a
+    removed target: those reached from it by steps that add one each time.
+    They are cleared and refilled from the unaffected cells around them.
+    """
+    dist, neighbors = self.dist, self.neighbors
+    affected = set(sources)
+    stack = list(sources)
+    while stack:
+      node = stack.pop()
+      depth = dist[node] + 1
+      for other in neighbors[node]:
+        if dist[other] == depth and other not in affected:
+          affected.add(other)
+          stack.append(other)
+    for node in affected:
+      dist[node] = UNREACHABLE
+    buckets = {}
+    for node in affected:
+      best = UNREACHABLE
+      for other in neighbors[node]:
+        if dist[other] + 1 < best:
+          best = dist[other] + 1
+      if best != UNREACHABLE:
+        dist[node] = best
+        buckets.setdefault(best, []).append(node)
+    self._relax(buckets)
+
+  def _relax(self, buckets):
+    "BFS outwards from the cells in buckets, a map from distance to cells"
+    dist, neighbors = self.dist, self.neighbors
+    if not buckets:
+      return
+    depth = min(buckets)
+    while buckets:
+      for node in buckets.pop(depth, ()):
+        if dist[node] != depth: continue # Reached sooner since it was queued
+        for other in neighbors[node]:
+          if dist[other] > depth + 1:
+            dist[other] = depth + 1
+            buckets.setdefault(depth + 1, []).append(other)
+      depth += 1
+
+
+##########################################
+# ON-DISK CACHE OF MAZE DISTANCES        #
+##########################################
+
+# Distance matrices are saved in a directory shared by every process the user
+# runs, so each layout is only solved once.  Set PACMAN_DISTANCE_CACHE to
+# choose the directory, or to an empty string to turn the cache off, and
+# PACMAN_DISTANCE_CACHE_MB to change how large it may grow.  Only a directory
+# and files that belong to the user and that no one else can write to are
+# used, so other users cannot hand an agent wrong distances.
+CACHE_DIR_VARIABLE = 'PACMAN_DISTANCE_CACHE'
+CACHE_SIZE_VARIABLE = 'PACMAN_DISTANCE_CACHE_MB'
+DEFAULT_CACHE_MB = 256
+
+# A file is this header (magic, number of cells) followed by the matrix
+CACHE_MAGIC = 'PACDIST1'
+CACHE_HEADER = struct.Struct('<8sI')
+CACHE_SUFFIX = '.dist'
+
+def getCacheDirectory():
+  """
+  Returns the cache directory, or None if the cache is turned off.  It is
+  under the user's cache directory ($XDG_CACHE_HOME or ~/.cache) by default.
+  """
+  directory = os.environ.get(CACHE_DIR_VARIABLE)
+  if directory == None:
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    if base.startswith('~'):
+      return None # No home directory to keep it in
+    directory = os.path.join(base, 'pacman-distance-cache')
+  return directory or None
+
+def isPrivate(info):
+  """
+  True if the os.stat result info is for a file or directory of this user
+  that no one else can write to.  Systems without user ids always pass.
+  """
+  if not hasattr(os, 'getuid'):
+    return True
+  return info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def getCachePath(directory, layout):
+  """
+  Files are named by a hash of the walls' fingerprint, so any layout with the
+  same walls shares one file.  The byte order of the machine is part of the
+  hash since the matrix is written in native order.
+  """
+  key = hashlib.sha1()
+  key.update('%s %s %s' % (CACHE_MAGIC, sys.byteorder, getLayoutKey(layout)))
+  return os.path.join(directory, key.hexdigest() + CACHE_SUFFIX)
+
+def loadCachedMatrix(layout):
+  """
+  Returns the layout's DistanceMatrix from the disk cache, or None.  The file
+  is memory-mapped, so with NumPy the distances are never copied and every
+  process using the layout shares the same pages.
+  """
+  directory = getCacheDirectory()
+  if directory == None:
+    return None
+  path = getCachePath(directory, layout)
+  cells = layout.walls.asList(False)
+  expectedSize = CACHE_HEADER.size + 2 * len(cells) ** 2
+  try:
+    if not isPrivate(os.stat(directory)):
+      return None
+    f = open(path, 'rb')
+    try:
+      info = os.fstat(f.fileno())
+      if info.st_size != expectedSize or not isPrivate(info):
+        return None
+      data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+      f.close()
+    magic, size = CACHE_HEADER.unpack_from(data)
+    if magic != CACHE_MAGIC or size != len(cells):
+      return None
+    # Eviction drops the files that were used least recently
+    os.utime(path, None)
+  except (IOError, OSError, EnvironmentError):
+    return None
+  return DistanceMatrix(cells, data, CACHE_HEADER.size)
+
+def storeCachedMatrix(layout, matrix):
+  """
+  Saves the matrix to the disk cache, if it is on.  The file is written
+  under a temporary name and renamed into place, which is atomic, so other
+  processes see either no file or a complete one.  Several processes storing
+  the same layout at once all write identical files.  A new directory is
+  made readable by the user only, and one that others could write to is not
+  used.  Failures are ignored: the cache only ever saves time.
+  """
+  directory = getCacheDirectory()
+  if directory == None:
+    return
+  path = getCachePath(directory, layout)
+  try:
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory, 0700)
+      except OSError:
+        if not os.path.isdir(directory): raise
+    if not isPrivate(os.stat(directory)):
+      return
+    fd, tempPath = tempfile.mkstemp(suffix='.tmp', prefix='.', dir=directory)
+    try:
+      f = os.fdopen(fd, 'wb')
+      try:
+        f.write(CACHE_HEADER.pack(CACHE_MAGIC, matrix.size))
+        f.write(matrix.flat.tostring())
+      finally:
+        f.close()
+      os.rename(tempPath, path)
+    except:
+      if os.path.exists(tempPath): os.remove(tempPath)
+      raise
+    evictCache(directory)
+  except (IOError, OSError, EnvironmentError):
+    pass
+
+def evictCache(directory):
+  """
+  Deletes the least recently used cache files until the directory is back
+  under its size limit.
+  """
+  try:
+    limit = float(os.environ.get(CACHE_SIZE_VARIABLE, DEFAULT_CACHE_MB)) * 1024 * 1024
+  except ValueError:
+    limit = DEFAULT_CACHE_MB * 1024 * 1024
+  entries = []
+  for name in os.listdir(directory):
+    if not name.endswith(CACHE_SUFFIX): continue
+    path = os.path.join(directory, name)
+    try:
+      info = os.stat(path)
+    except OSError:
+      continue # Another process evicted it first
+    entries.append((info.st_mtime, info.st_size, path))
+  entries.sort()
+  total = sum([size for mtime, size, path in entries])
+  for mtime, size, path in entries:
+    if total <= limit: break
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+    total -= size
 
 def getDistanceOnGrid(distances, pos1, pos2):
     key = (pos1, pos2)
@@ -23,6 +23,9 @@
 from util import *
 import time, os
 import traceback
+import hashlib, struct
+import weakref
+from itertools import compress
 import sys
 
 #######################
@@ -67,7 +70,15 @@ class Directions:
                WEST: EAST,
                STOP: STOP}
 
-class Configuration:
+def _getSlotState(self):
+    "__getstate__ for slotted classes, so they pickle under every protocol."
+    return dict([(name, getattr(self, name)) for name in self.__slots__ if hasattr(self, name)])
+
+def _setSlotState(self, state):
+    for name, value in state.items():
+        setattr(self, name, value)
+
+class Configuration(object):
     """
     A Configuration holds the (x,y) coordinate of a character, along with its
     traveling direction.
@@ -75,6 +86,9 @@ class Configuration:
     The convention for positions, like a graph, is that (0,0) is the lower left corner, x increases
     horizontally and y increases vertically.  Therefore, north is the direction of increasing y, or (0,1).
     """
+    __slots__ = ('pos', 'direction')
+    __getstate__ = _getSlotState
+    __setstate__ = _setSlotState
 
     def __init__(self, pos, direction):
         self.pos = pos
@@ -117,10 +131,13 @@ class Configuration:
             direction = self.direction # There is no stop direction
         return Configuration((x + dx, y+dy), direction)
 
-class AgentState:
+class AgentState(object):
     """
     AgentStates hold the state of an agent (configuration, speed, scared, etc).
     """
+    __slots__ = ('start', 'configuration', 'isPacman', 'scaredTimer', 'numCarrying', 'numReturned')
+    __getstate__ = _getSlotState
+    __setstate__ = _setSlotState
 
     def __init__( self, startConfiguration, isPacman ):
         self.start = startConfiguration
@@ -145,7 +162,10 @@ class AgentState:
         return hash(hash(self.configuration) + 13 * hash(self.scaredTimer))
 
     def copy( self ):
-        state = AgentState( self.start, self.isPacman )
+        # Skip __init__: every field is assigned here
+        state = object.__new__( self.__class__ )
+        state.start = self.start
+        state.isPacman = self.isPacman
         state.configuration = self.configuration
         state.scaredTimer = self.scaredTimer
         state.numCarrying = self.numCarrying
@@ -190,7 +210,10 @@ class Grid:
 
     def __eq__(self, other):
         if other == None: return False
-        return self.data == other.data
+        if type(self.data) is type(other.data):
+            return self.data == other.data
+        # Read-only grids, like layout walls, keep their cells in tuples
+        return [list(x) for x in self.data] == [list(x) for x in other.data]
 
     def __hash__(self):
         # return hash(str(self))
@@ -205,7 +228,7 @@ class Grid:
 
     def copy(self):
         g = Grid(self.width, self.height)
-        g.data = [x[:] for x in self.data]
+        g.data = [list(x) for x in self.data]
         return g
 
     def deepCopy(self):
@@ -274,11 +297,175 @@ class Grid:
                 bools.append(False)
         return bools
 
+class BitGrid(Grid):
+    """
+    A boolean Grid backed by a single Python int.  Cell (x,y) is bit
+    x * height + y, the same column-major order used by packBits, so the
+    bits are also the value Grid.__hash__ computes for the same contents.
+
+    grid[x][y] reads and writes work as for Grid, but copy, count, asList,
+    __eq__ and __hash__ no longer walk every cell.  The data attribute is a
+    new list of the grid[x] column views on each access: data[x][y] reads
+    and writes go through to the grid, but replacing a whole column with
+    data[x] = ... only changes that list.
+    """
+    def __init__(self, width, height, initialValue=False, bitRepresentation=None, bits=0):
+        if initialValue not in [False, True]: raise Exception('Grids can only contain booleans')
+        self.CELLS_PER_INT = 30
+
+        self.width = width
+        self.height = height
+        self._full = (1 << (width * height)) - 1
+        self._bits = self._full if initialValue else bits
+        self._columns = {}
+        if bitRepresentation:
+            self._unpackBits(bitRepresentation)
+
+    def __getitem__(self, i):
+        try:
+            return self._columns[i]
+        except KeyError:
+            if i < 0: i += self.width
+            if i < 0 or i >= self.width: raise IndexError('grid index out of range')
+            column = self._columns[i] = _BitColumn(self, i)
+            return column
+
+    def __setitem__(self, key, item):
+        column = self[key]
+        for y in range(self.height):
+            column[y] = item[y]
+
+    def _getData(self):
+        return [self[x] for x in range(self.width)]
+    data = property(_getData)
+
+    def __str__(self):
+        # Cell (x,y) is character x * height + y, counting from the low bit
+        cells = bin(self._bits)[:1:-1].ljust(self.width * self.height, '0')
+        rows = []
+        for y in range(self.height - 1, -1, -1):
+            rows.append(''.join(['FT'[cells[x * self.height + y] == '1'] for x in range(self.width)]))
+        return '\n'.join(rows)
+
+    def __getstate__(self):
+        # The column views are a cache bound to this grid; rebuild them on load
+        state = self.__dict__.copy()
+        state['_columns'] = {}
+        return state
+
+    def __eq__(self, other):
+        if other == None: return False
+        if isinstance(other, BitGrid):
+            return self._bits == other._bits and self.width == other.width and self.height == other.height
+        return Grid.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._bits)
+
+    def copy(self):
+        return BitGrid(self.width, self.height, bits=self._bits)
+
+    def shallowCopy(self):
+        # Ints are immutable, so a shallow copy is as cheap as a deep one
+        return self.copy()
+
+    def count(self, item =True ):
+        n = bin(self._bits).count('1')
+        if item: return n
+        return self.width * self.height - n
+
+    def asList(self, key = True):
+        bits = self._bits if key else self._full & ~self._bits
+        # Walk the binary string from the low bit up, so cells come out in the
+        # same column-major order as Grid.asList
+        flags = bytearray(bin(bits)[:1:-1].replace('0', '\x00'))
+        return list(compress(_cellPositions(self.width, self.height), flags))
+
+    def packBits(self):
+        """
+        Returns an efficient int list representation
+
+        (width, height, bitPackedInts...)
+        """
+        ints = [0] * (self.width * self.height / self.CELLS_PER_INT + 1)
+        bits = self._bits
+        while bits:
+            low = bits & -bits
+            index = low.bit_length() - 1
+            ints[index / self.CELLS_PER_INT] += 2 ** (self.CELLS_PER_INT - (index % self.CELLS_PER_INT) - 1)
+            bits ^= low
+        return tuple([self.width, self.height] + ints)
+
+    def _unpackBits(self, bits):
+        """
+        Fills in data from a bit-level representation
+        """
+        cells = self.width * self.height
+        value = 0
+        for chunk, packed in enumerate(bits):
+            for i, bit in enumerate(self._unpackInt(packed, self.CELLS_PER_INT)):
+                cell = chunk * self.CELLS_PER_INT + i
+                if cell == cells: break
+                if bit: value |= 1 << cell
+        self._bits = value
+
+_CELL_POSITIONS = {}
+
+def _cellPositions(width, height):
+    "Maps each BitGrid bit index to its (x,y) cell for grids of this shape."
+    key = (width, height)
+    if key not in _CELL_POSITIONS:
+        _CELL_POSITIONS[key] = [(x, y) for x in range(width) for y in range(height)]
+    return _CELL_POSITIONS[key]
+
+class _BitColumn(object):
+    """
+    The grid[x] view of one column of a BitGrid.
+    """
+    __slots__ = ('_grid', '_offset', '_height')
+
+    def __init__(self, grid, x):
+        self._grid = grid
+        self._offset = x * grid.height
+        self._height = grid.height
+
+    def __len__(self):
+        return self._height
+
+    def __getitem__(self, y):
+        if 0 <= y < self._height:
+            return (self._grid._bits >> (self._offset + y)) & 1 == 1
+        if -self._height <= y < 0:
+            return self[y + self._height]
+        raise IndexError('grid index out of range')
+
+    def __setitem__(self, y, value):
+        if y < 0: y += self._height
+        if y < 0 or y >= self._height: raise IndexError('grid index out of range')
+        if value:
+            self._grid._bits |= 1 << (self._offset + y)
+        else:
+            self._grid._bits &= ~(1 << (self._offset + y))
+
+    def __iter__(self):
+        bits = self._grid._bits >> self._offset
+        for y in range(self._height):
+            yield (bits >> y) & 1 == 1
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
 def reconstituteGrid(bitRep):
     if type(bitRep) is not type((1,2)):
         return bitRep
     width, height = bitRep[:2]
-    return Grid(width, height, bitRepresentation= bitRep[2:])
+    return BitGrid(width, height, bitRepresentation= bitRep[2:])
 
 ####################################
 # Parts you shouldn't have to read #
@@ -330,7 +517,6 @@ class Actions:
     directionToVector = staticmethod(directionToVector)
 
     def getPossibleActions(config, walls):
-        possible = []
         x, y = config.pos
         x_int, y_int = int(x + 0.5), int(y + 0.5)
 
@@ -338,19 +524,31 @@ class Actions:
         if (abs(x - x_int) + abs(y - y_int)  > Actions.TOLERANCE):
             return [config.getDirection()]
 
+        possible = Actions._getMoveTable(walls)[0].get((x_int, y_int))
+        if possible != None: return possible[:]
+        return Actions._computePossibleActions(x_int, y_int, walls)
+
+    getPossibleActions = staticmethod(getPossibleActions)
+
+    def getLegalNeighbors(position, walls):
+        x,y = position
+        x_int, y_int = int(x + 0.5), int(y + 0.5)
+        neighbors = Actions._getMoveTable(walls)[1].get((x_int, y_int))
+        if neighbors != None: return neighbors[:]
+        return Actions._computeLegalNeighbors(x_int, y_int, walls)
+    getLegalNeighbors = staticmethod(getLegalNeighbors)
+
+    def _computePossibleActions(x_int, y_int, walls):
+        possible = []
         for dir, vec in Actions._directionsAsList:
             dx, dy = vec
             next_y = y_int + dy
             next_x = x_int + dx
             if not walls[next_x][next_y]: possible.append(dir)
-
         return possible
+    _computePossibleActions = staticmethod(_computePossibleActions)
 
-    getPossibleActions = staticmethod(getPossibleActions)
-
-    def getLegalNeighbors(position, walls):
-        x,y = position
-        x_int, y_int = int(x + 0.5), int(y + 0.5)
+    def _computeLegalNeighbors(x_int, y_int, walls):
         neighbors = []
         for dir, vec in Actions._directionsAsList:
             dx, dy = vec
@@ -360,7 +558,37 @@ class Actions:
             if next_y < 0 or next_y == walls.height: continue
             if not walls[next_x][next_y]: neighbors.append((next_x, next_y))
         return neighbors
-    getLegalNeighbors = staticmethod(getLegalNeighbors)
+    _computeLegalNeighbors = staticmethod(_computeLegalNeighbors)
+
+    # Per walls grid: (weakref to the grid, {cell: actions}, {cell: neighbors})
+    _moveTables = {}
+
+    def _getMoveTable(walls):
+        """
+        Returns the ({cell: legal actions}, {cell: legal neighbors}) tables for
+        every integer cell of the walls grid, building them on first use.
+        Layouts never change their walls once built, so one table serves every
+        state of a game.  Cells whose lookups would fall off the grid are left
+        out and handled by the slow path.
+        """
+        key = id(walls)
+        entry = Actions._moveTables.get(key)
+        if entry != None and entry[0]() is walls:
+            return entry[1], entry[2]
+
+        actions, neighbors = {}, {}
+        for x in range(walls.width):
+            for y in range(walls.height):
+                neighbors[(x, y)] = Actions._computeLegalNeighbors(x, y, walls)
+                try:
+                    actions[(x, y)] = Actions._computePossibleActions(x, y, walls)
+                except IndexError:
+                    pass
+        def forget(ref, key=key, tables=Actions._moveTables):
+            if key in tables and tables[key][0] is ref: del tables[key]
+        Actions._moveTables[key] = (weakref.ref(walls, forget), actions, neighbors)
+        return actions, neighbors
+    _getMoveTable = staticmethod(_getMoveTable)
 
     def getSuccessor(position, action):
         dx, dy = Actions.directionToVector(action)
@@ -368,10 +596,19 @@ class Actions:
         return (x + dx, y + dy)
     getSuccessor = staticmethod(getSuccessor)
 
-class GameStateData:
+class GameStateData(object):
     """
-
+    The data behind a GameState: food, capsules, agent states, score and the
+    bookkeeping the displays read.  The attributes are fixed by __slots__,
+    which keeps these objects small since search copies them constantly.
     """
+    __slots__ = ('food', 'capsules', 'agentStates', 'layout', '_eaten', 'score',
+                 '_foodEaten', '_foodAdded', '_capsuleEaten', '_agentMoved',
+                 '_lose', '_win', 'scoreChange', 'timeleft', '_zobrist',
+                 'redReturned', 'blueReturned', 'redCarrying', 'blueCarrying')
+    __getstate__ = _getSlotState
+    __setstate__ = _setSlotState
+
     def __init__( self, prevState = None ):
         """
         Generates a new data packet by copying information from its predecessor.
@@ -383,6 +620,10 @@ class GameStateData:
             self.layout = prevState.layout
             self._eaten = prevState._eaten
             self.score = prevState.score
+            self.redReturned = prevState.redReturned
+            self.blueReturned = prevState.blueReturned
+            self.redCarrying = prevState.redCarrying
+            self.blueCarrying = prevState.blueCarrying
 
         self._foodEaten = None
         self._foodAdded = None
@@ -391,11 +632,14 @@ class GameStateData:
         self._lose = False
         self._win = False
         self.scoreChange = 0
+        # Zobrist key of the state, or None until it is first asked for
+        self._zobrist = None
 
     def deepCopy( self ):
         state = GameStateData( self )
         state.food = self.food.deepCopy()
-        state.layout = self.layout.deepCopy()
+        # The layout is immutable and shared by every copy of the state
+        state._zobrist = self._zobrist
         state._agentMoved = self._agentMoved
         state._foodEaten = self._foodEaten
         state._foodAdded = self._foodAdded
@@ -403,10 +647,7 @@ class GameStateData:
         return state
 
     def copyAgentStates( self, agentStates ):
-        copiedStates = []
-        for agentState in agentStates:
-            copiedStates.append( agentState.copy() )
-        return copiedStates
+        return [agentState.copy() for agentState in agentStates]
 
     def __eq__( self, other ):
         """
@@ -424,13 +665,59 @@ class GameStateData:
         """
         Allows states to be keys of dictionaries.
         """
-        for i, state in enumerate( self.agentStates ):
-            try:
-                int(hash(state))
-            except TypeError, e:
-                print e
-                #hash(state)
-        return int((hash(tuple(self.agentStates)) + 13*hash(self.food) + 113* hash(tuple(self.capsules)) + 7 * hash(self.score)) % 1048575 )
+        return hash(self.getZobristKey())
+
+    def getZobristKey( self ):
+        """
+        Returns a 64-bit Zobrist key covering everything __eq__ compares.  The
+        key is computed in full the first time it is needed; after that the
+        game rules keep it current with the hash* methods below, so asking
+        for it is O(1).  Keys do not depend on the process, so they can be
+        shared between workers.
+        """
+        if self._zobrist == None:
+            key = zobristKey(('score', self.score))
+            for x, y in self.food.asList():
+                key ^= zobristKey(('food', x, y))
+            for x, y in self.capsules:
+                key ^= zobristKey(('capsule', x, y))
+            for index in range(len(self.agentStates)):
+                key ^= self._agentZobristKey(index)
+            self._zobrist = key
+        return self._zobrist
+
+    def _agentZobristKey( self, index ):
+        agentState = self.agentStates[index]
+        conf = agentState.configuration
+        if conf == None:
+            return zobristKey(('agent', index, None, None, None, agentState.scaredTimer))
+        x, y = conf.pos
+        return zobristKey(('agent', index, x, y, conf.direction, agentState.scaredTimer))
+
+    # Each of these XORs one feature of the state in or out of the Zobrist
+    # key, so call it once before and once after changing that feature.
+
+    def hashAgent( self, index ):
+        "Toggles the configuration and scared timer of agent index."
+        if self._zobrist != None:
+            self._zobrist ^= self._agentZobristKey(index)
+
+    def hashFood( self, position ):
+        "Toggles the food at position."
+        if self._zobrist != None:
+            x, y = position
+            self._zobrist ^= zobristKey(('food', x, y))
+
+    def hashCapsule( self, position ):
+        "Toggles the capsule at position."
+        if self._zobrist != None:
+            x, y = position
+            self._zobrist ^= zobristKey(('capsule', x, y))
+
+    def hashScore( self ):
+        "Toggles the current score."
+        if self._zobrist != None:
+            self._zobrist ^= zobristKey(('score', self.score))
 
     def __str__( self ):
         width, height = self.layout.width, self.layout.height
@@ -494,6 +781,10 @@ class GameStateData:
         self.layout = layout
         self.score = 0
         self.scoreChange = 0
+        # Team totals of the agents' numReturned and numCarrying, which the
+        # capture rules keep current so nobody has to sum over agent states
+        self.redReturned = self.blueReturned = 0
+        self.redCarrying = self.blueCarrying = 0
 
         self.agentStates = []
         numGhosts = 0
@@ -504,6 +795,23 @@ class GameStateData:
             self.agentStates.append( AgentState( Configuration( pos, Directions.STOP), isPacman) )
         self._eaten = [False for a in self.agentStates]
 
+_ZOBRIST_KEYS = {}
+
+def zobristKey( feature ):
+    """
+    Returns the 64-bit Zobrist key for a feature tuple of strings, numbers
+    and None.  Keys come from an md5 digest of the feature, with numbers
+    written as floats so that (1, 2) and (1.0, 2.0) get the same key, which
+    makes them identical in every process.
+    """
+    try:
+        return _ZOBRIST_KEYS[feature]
+    except KeyError:
+        text = ','.join([repr(float(f)) if isinstance(f, (int, long, float)) else repr(f) for f in feature])
+        key = struct.unpack('<Q', hashlib.md5(text).digest()[:8])[0]
+        _ZOBRIST_KEYS[feature] = key
+        return key
+
 try:
     import boinc
     _BOINC_ENABLED = True
@@ -515,7 +823,7 @@ class Game:
     The Game manages the control flow, soliciting actions from agents.
     """
 
-    def __init__( self, agents, display, rules, startingIndex=0, muteAgents=False, catchExceptions=False ):
+    def __init__( self, agents, display, rules, startingIndex=0, muteAgents=False, catchExceptions=False, headless=False ):
         self.agentCrashed = False
         self.agents = agents
         self.display = display
@@ -524,6 +832,8 @@ class Game:
         self.gameOver = False
         self.muteAgents = muteAgents
         self.catchExceptions = catchExceptions
+        # A headless game never touches the display, for bulk simulation
+        self.headless = headless
         self.moveHistory = []
         self.totalAgentTimes = [0 for agent in agents]
         self.totalAgentTimeWarnings = [0 for agent in agents]
@@ -568,7 +878,8 @@ class Game:
         """
         Main control loop for game play.
         """
-        self.display.initialize(self.state.data)
+        if not self.headless:
+            self.display.initialize(self.state.data)
         self.numMoves = 0
 
         ###self.display.initialize(self.state.makeObservation(1).data)
@@ -610,6 +921,8 @@ class Game:
 
         agentIndex = self.startingIndex
         numAgents = len( self.agents )
+        # Agents don't grow methods mid-game, so look this up once
+        observers = ['observationFunction' in dir( agent ) for agent in self.agents]
 
         while not self.gameOver:
             # Fetch the next agent
@@ -617,7 +930,7 @@ class Game:
             move_time = 0
             skip_action = False
             # Generate an observation of the state
-            if 'observationFunction' in dir( agent ):
+            if observers[agentIndex]:
                 self.mute(agentIndex)
                 if self.catchExceptions:
                     try:
@@ -700,7 +1013,8 @@ class Game:
                 self.state = self.state.generateSuccessor( agentIndex, action )
 
             # Change the display
-            self.display.update( self.state.data )
+            if not self.headless:
+                self.display.update( self.state.data )
             ###idx = agentIndex - agentIndex % 2 + 1
             ###self.display.update( self.state.makeObservation(idx).data )
 
@@ -726,4 +1040,5 @@ class Game:
                     self._agentCrash(agentIndex)
                     self.unmute()
                     return
-        self.display.finish()
+        if not self.headless:
+            self.display.finish()
@@ -13,29 +13,47 @@
 
 
 from util import manhattanDistance
-from game import Grid
+from game import Grid, BitGrid
 import os
 import random
+import hashlib
 
 VISIBILITY_MATRIX_CACHE = {}
 
 class Layout:
     """
     A Layout manages the static information about the game board.
+
+    Layouts are frozen once constructed: every GameState built from a layout
+    shares the same instance, so deepCopy returns self rather than re-parsing
+    the layout text.  The parts of the board that change during a game (food
+    and capsules) are copied into GameStateData and copied on write there.
+    The walls never change, and every game and every table of per-maze data
+    keyed by them relies on that, so their cells are read-only: writing one
+    raises a TypeError.  Copy the grid to get walls that can be changed.
     """
 
     def __init__(self, layoutText):
         self.width = len(layoutText[0])
         self.height= len(layoutText)
         self.walls = Grid(self.width, self.height, False)
-        self.food = Grid(self.width, self.height, False)
+        self.food = BitGrid(self.width, self.height, False)
         self.capsules = []
         self.agentPositions = []
         self.numGhosts = 0
         self.processLayoutText(layoutText)
+        self.walls.data = tuple([tuple(column) for column in self.walls.data])
         self.layoutText = layoutText
         self.totalFood = len(self.food.asList())
+        # Identifies the walls, for tables of per-maze data such as distances
+        self.fingerprint = wallsFingerprint(self.walls)
         # self.initializeVisibilityMatrix()
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if self.__dict__.get('_frozen', False):
+            raise AttributeError('Layout is immutable; cannot set %s' % name)
+        self.__dict__[name] = value
 
     def getNumGhosts(self):
         return self.numGhosts
@@ -56,10 +74,10 @@ class Layout:
                             while (nextx + nexty) != int(nextx) + int(nexty) or not self.walls[int(nextx)][int(nexty)] :
                                 vis[x][y][direction].add((nextx, nexty))
                                 nextx, nexty = x + dx, y + dy
-            self.visibility = vis
+            self.__dict__['visibility'] = vis
             VISIBILITY_MATRIX_CACHE[reduce(str.__add__, self.layoutText)] = vis
         else:
-            self.visibility = VISIBILITY_MATRIX_CACHE[reduce(str.__add__, self.layoutText)]
+            self.__dict__['visibility'] = VISIBILITY_MATRIX_CACHE[reduce(str.__add__, self.layoutText)]
 
     def isWall(self, pos):
         x, col = pos
@@ -90,7 +108,8 @@ class Layout:
         return "\n".join(self.layoutText)
 
     def deepCopy(self):
-        return Layout(self.layoutText[:])
+        "Layouts are immutable, so copies share the original instance."
+        return self
 
     def processLayoutText(self, layoutText):
         """
@@ -128,6 +147,16 @@ class Layout:
         elif layoutChar in  ['1', '2', '3', '4']:
             self.agentPositions.append( (int(layoutChar), (x,y)))
             self.numGhosts += 1
+def wallsFingerprint(walls):
+    """
+    A hex digest of the shape and walls of a wall grid.  Grids with the same
+    walls get the same fingerprint, unlike hashing the Grid, which walks every
+    cell each time.
+    """
+    key = hashlib.sha1('%d %d ' % (walls.width, walls.height))
+    key.update(''.join([walls[x][y] and '1' or '0' for x in range(walls.width) for y in range(walls.height)]))
+    return key.hexdigest()
+
 def getLayout(name, back = 2):
     if name.endswith('.lay'):
         layout = tryToLoad('layouts/' + name)
@@ -0,0 +1,211 @@
+# layoutAnalysis.py
+# -----------------
+# Licensing Information:  You are free to use or extend these projects for
+# educational purposes provided that (1) you do not distribute or publish
+# solutions, (2) you retain this notice, and (3) you provide clear
+# attribution to UC Berkeley, including a link to http://ai.berkeley.edu.
+#
+# Attribution Information: The Pacman AI projects were developed at UC Berkeley.
+# The core projects and autograders were primarily created by John DeNero
+# (denero@cs.berkeley.edu) and Dan Klein (klein@cs.berkeley.edu).
+# Student side autograding was added by Brad Miller, Nick Hay, and
+# Pieter Abbeel (pabbeel@cs.berkeley.edu).
+
+
+"""
+This file contains a LayoutAnalysis object which works out the shape of a
+maze once, so agents can ask about it in constant time.
+
+An alley is a part of the maze with no loops in it: whichever way an agent
+goes inside one, it ends up at a dead end or back where the alley joins the
+rest of the maze, at its exit.  Every cell of an alley is a dead-end cell.
+
+Example:
+analysis = getLayoutAnalysis(gameState.data.layout)
+analysis.isDeadEnd( (1,1) )
+"""
+
+from collections import deque
+import distanceCalculator
+
+class LayoutAnalysis:
+    def __init__(self, layout):
+        """
+        Analyses the walls of layout.  Use getLayoutAnalysis(layout) instead,
+        which only does this once for each maze.
+        """
+        self.width = layout.width
+        self.height = layout.height
+        cells = layout.walls.asList(False)
+        neighbors = distanceCalculator.getNeighborIndices(layout.walls, cells)
+        self._findAlleys(cells, neighbors)
+        self.articulationPoints = frozenset([cells[i] for i in findArticulationPoints(neighbors)])
+        self._findBorderEntries(layout.walls)
+
+    def isDeadEnd(self, pos):
+        "True if pos is in an alley"
+        return pos in self.alleyDepth
+
+    def getAlleyDepth(self, pos):
+        "Moves from pos out to its alley's exit; 0 outside alleys"
+        return self.alleyDepth.get(pos, 0)
+
+    def getAlleyExit(self, pos):
+        """
+        The cell outside the alley that alley cell pos leads out to.  None
+        outside alleys, and for mazes with no loops at all.
+        """
+        return self.alleyExit.get(pos)
+
+    def getAlleyHeight(self, pos):
+        "Moves from alley cell pos to the farthest dead end beyond it"
+        return self.alleyHeight.get(pos, 0)
+
+    def getAlleyCells(self, pos):
+        """
+        The cells of the alley from alley cell pos inwards: pos and every cell
+        that can only be reached from the exit through it.
+        """
+        cells = [pos]
+        for cell in cells:
+            cells.extend(self.alleyChildren.get(cell, ()))
+        return cells
+
+    def isAlleyEntry(self, pos, nextPos):
+        """
+        True if moving from pos to the adjacent nextPos goes deeper into an
+        alley, so that nextPos can only be left again through pos.
+        """
+        return nextPos in self.alleyParent and self.alleyParent[nextPos] == pos
+
+    def isArticulationPoint(self, pos):
+        "True if blocking pos would cut the maze in two"
+        return pos in self.articulationPoints
+
+    def getBorderEntries(self, isRed):
+        """
+        The open cells on the red or blue side of the border that an agent
+        can cross to the other side from.
+        """
+        if isRed: return self.redBorderEntries
+        return self.blueBorderEntries
+
+    def isBorderEntry(self, pos):
+        return pos in self.borderEntries
+
+    def _findAlleys(self, cells, neighbors):
+        """
+        Peels off cells with at most one open neighbor left, like leaves off
+        a tree, until only the loops are left.  Each peeled cell is in an
+        alley, and the neighbor left when it was peeled is its parent, one
+        move closer to the exit.
+        """
+        degree = [len(adjacent) for adjacent in neighbors]
+        peeled = [False] * len(cells)
+        parent = [None] * len(cells)
+        order = []
+        leaves = deque([i for i in range(len(cells)) if degree[i] <= 1])
+        while leaves:
+            node = leaves.popleft()
+            peeled[node] = True
+            order.append(node)
+            for other in neighbors[node]:
+                if not peeled[other]:
+                    parent[node] = other
+                    degree[other] -= 1
+                    if degree[other] == 1:
+                        leaves.append(other)
+
+        self.alleyParent = {}
+        self.alleyChildren = {}
+        self.alleyDepth = {}
+        self.alleyExit = {}
+        self.alleyHeight = {}
+        # Parents are peeled after their children, so walk back down from
+        # the exits for depths and up from the dead ends for heights
+        for node in reversed(order):
+            cell = cells[node]
+            up = parent[node]
+            if up == None:
+                # The last cell of a part of the maze with no loops
+                self.alleyDepth[cell] = 0
+            elif peeled[up]:
+                self.alleyParent[cell] = cells[up]
+                self.alleyChildren.setdefault(cells[up], []).append(cell)
+                self.alleyDepth[cell] = self.alleyDepth[cells[up]] + 1
+                if cells[up] in self.alleyExit:
+                    self.alleyExit[cell] = self.alleyExit[cells[up]]
+            else:
+                self.alleyParent[cell] = cells[up]
+                self.alleyDepth[cell] = 1
+                self.alleyExit[cell] = cells[up]
+            self.alleyHeight[cell] = 0
+        for node in order:
+            up = parent[node]
+            if up != None and peeled[up]:
+                height = self.alleyHeight[cells[node]] + 1
+                if self.alleyHeight[cells[up]] < height:
+                    self.alleyHeight[cells[up]] = height
+
+    def _findBorderEntries(self, walls):
+        halfway = self.width / 2
+        self.redBorderEntries = []
+        self.blueBorderEntries = []
+        for y in range(self.height):
+            if not walls[halfway - 1][y] and not walls[halfway][y]:
+                self.redBorderEntries.append((halfway - 1, y))
+                self.blueBorderEntries.append((halfway, y))
+        self.borderEntries = frozenset(self.redBorderEntries + self.blueBorderEntries)
+
+def findArticulationPoints(neighbors):
+    """
+    The indices of the cells whose removal disconnects the graph, by Tarjan's
+    depth-first search.  It uses an explicit stack, since the recursive form
+    would go deeper than Python allows on large mazes.
+    """
+    n = len(neighbors)
+    discovered = [-1] * n
+    low = [0] * n
+    points = set()
+    time = 0
+    for root in range(n):
+        if discovered[root] != -1: continue
+        discovered[root] = low[root] = time
+        time += 1
+        rootChildren = 0
+        # (node, its parent, index of the next neighbor to visit)
+        stack = [(root, -1, 0)]
+        while stack:
+            node, up, i = stack[-1]
+            if i < len(neighbors[node]):
+                stack[-1] = (node, up, i + 1)
+                other = neighbors[node][i]
+                if discovered[other] == -1:
+                    discovered[other] = low[other] = time
+                    time += 1
+                    if node == root: rootChildren += 1
+                    stack.append((other, node, 0))
+                elif other != up and discovered[other] < low[node]:
+                    low[node] = discovered[other]
+            else:
+                stack.pop()
+                if up != -1:
+                    if low[node] < low[up]:
+                        low[up] = low[node]
+                    if up != root and low[node] >= discovered[up]:
+                        points.add(up)
+        if rootChildren > 1:
+            points.add(root)
+    return points
+
+analysisMap = {}
+
+def getLayoutAnalysis(layout):
+    """
+    Returns the LayoutAnalysis of layout's walls, shared like its distances
+    by every agent in the process.
+    """
+    key = distanceCalculator.getLayoutKey(layout)
+    if key not in analysisMap:
+        analysisMap[key] = LayoutAnalysis(layout)
+    return analysisMap[key]
@@ -1,10 +1,15 @@
 from captureAgents import CaptureAgent
 from captureAgents import AgentFactory
-from game import Directions
+from game import Directions, Actions, Configuration
+from capture import SCARED_TIME
 import random, time, util
 from util import nearestPoint
 from util import pause
 
+# Random walks played from each move the Attacker considers, and their length
+NUM_ROLLOUTS = 30
+ROLLOUT_DEPTH = 10
+
 def createTeam(firstIndex, secondIndex, isRed,
                first = 'Attacker', second = 'Defender'):
 
@@ -75,32 +80,35 @@ class Attacker(EvaluationBasedAgent):
     """
     Get features used for state evaluation.
     """
-    features = util.Counter()
     successor = self.getSuccessor(gameState, action)
+    myState = successor.getAgentState(self.index)
+    return self.featuresFor(self.getScore(successor), myState.getPosition(), myState.isPacman,
+                            self.getFood(successor).asList(), self.getGhosts(successor))
+
+  def featuresFor(self, score, myPos, isPacman, foodList, ghosts):
+    """
+    The features of a state where the agent is at myPos with the given score,
+    food left to eat and (position, scaredTimer) of the ghosts it can see.
+    """
+    features = util.Counter()
 
     # Compute score from successor state
-    features['successorScore'] = self.getScore(successor)
+    features['successorScore'] = score
 
     # Compute distance to the nearest food
-    foodList = self.getFood(successor).asList()
     if len(foodList) > 0:
-      myPos = successor.getAgentState(self.index).getPosition()
-      minDistance = min([self.getMazeDistance(myPos, food) for food in foodList])
+      minDistance = self.distancer.nearest(myPos, foodList)[1]
       features['distanceToFood'] = minDistance
 
     # Compute distance to closest ghost
-    myPos = successor.getAgentState(self.index).getPosition()
-    enemies  = [successor.getAgentState(i) for i in self.getOpponents(successor)]
-    inRange = filter(lambda x: not x.isPacman and x.getPosition() != None, enemies)
-    if len(inRange) > 0:
-      positions = [agent.getPosition() for agent in inRange]
-      closest = min(positions, key = lambda x: self.getMazeDistance(myPos, x))
-      closestDist = self.getMazeDistance(myPos, closest)
+    if len(ghosts) > 0:
+      positions = [pos for pos, scaredTimer in ghosts]
+      closest, closestDist = self.distancer.nearest(myPos, positions)
       if closestDist <= 5:
         features['distanceToGhost'] = closestDist
 
     # Compute if is pacman
-    features['isPacman'] = 1 if successor.getAgentState(self.index).isPacman else 0
+    features['isPacman'] = 1 if isPacman else 0
 
     return features
 
@@ -108,32 +116,44 @@ class Attacker(EvaluationBasedAgent):
     """
     Get weights for the features used in the evaluation.
     """
+    successor = self.getSuccessor(gameState, action)
+    myPos = successor.getAgentState(self.index).getPosition()
+    return self.weightsFor(myPos, self.getGhosts(successor))
+
+  def weightsFor(self, myPos, ghosts):
+    "The weights for featuresFor with the same position and ghosts"
     # If tha agent is locked, we will make him try and atack
     if self.inactiveTime > 80:
       return {'successorScore': 200, 'distanceToFood': -5, 'distanceToGhost': 2, 'isPacman': 1000}
 
     # If opponent is scared, the agent should not care about distanceToGhost
-    successor = self.getSuccessor(gameState, action)
-    myPos = successor.getAgentState(self.index).getPosition()
-    enemies  = [successor.getAgentState(i) for i in self.getOpponents(successor)]
-    inRange = filter(lambda x: not x.isPacman and x.getPosition() != None, enemies)
-    if len(inRange) > 0:
-      positions = [agent.getPosition() for agent in inRange]
-      closestPos = min(positions, key = lambda x: self.getMazeDistance(myPos, x))
-      closestDist = self.getMazeDistance(myPos, closestPos)
-      closest_enemies = filter(lambda x: x[0] == closestPos, zip(positions, inRange))
-      for agent in closest_enemies:
-        if agent[1].scaredTimer > 0:
+    if len(ghosts) > 0:
+      positions = [pos for pos, scaredTimer in ghosts]
+      closestPos, closestDist = self.distancer.nearest(myPos, positions)
+      for pos, scaredTimer in ghosts:
+        if pos == closestPos and scaredTimer > 0:
           return {'successorScore': 200, 'distanceToFood': -5, 'distanceToGhost': 0, 'isPacman': 0}
 
     # Weights normally used
     return {'successorScore': 200, 'distanceToFood': -5, 'distanceToGhost': 2, 'isPacman': 0}
 
+  def getGhosts(self, gameState):
+    "(position, scaredTimer) of each opponent seen as a ghost"
+    ghosts = []
+    for i in self.getOpponents(gameState):
+      enemy = gameState.getAgentState(i)
+      if not enemy.isPacman and enemy.getPosition() != None:
+        ghosts.append((enemy.getPosition(), enemy.scaredTimer))
+    return ghosts
+
   def randomSimulation(self, depth, gameState):
     """
     Random simulate some actions for the agent. The actions other agents can take
     are ignored, or, in other words, we consider their actions is always STOP.
     The final state from the simulation is evaluated.
+
+    chooseAction plays the same walks with a RolloutSimulator, which does
+    not build a GameState for every step.
     """
     new_state = gameState.deepCopy()
     while depth > 0:
@@ -158,24 +178,41 @@ class Attacker(EvaluationBasedAgent):
     """
     Verify if an action takes the agent to an alley with
     no pacdots.
+
+    The layout analysis says whether the action goes deeper into an alley,
+    how far that alley goes and which cells it has, so no successor states
+    are expanded.  An alley with a dangerous opponent in sight is not
+    empty.
     """
     if depth == 0:
       return False
-    old_score = self.getScore(gameState)
-    new_state = gameState.generateSuccessor(self.index, action)
-    new_score = self.getScore(new_state)
-    if old_score < new_score:
+    x, y = gameState.getAgentPosition(self.index)
+    dx, dy = Actions.directionToVector(action)
+    nextPos = (int(x + dx), int(y + dy))
+    if not self.analysis.isAlleyEntry((x, y), nextPos) or self.analysis.getAlleyHeight(nextPos) >= depth:
       return False
-    actions   = new_state.getLegalActions(self.index)
-    actions.remove(Directions.STOP)
-    reversed_direction = Directions.REVERSE[new_state.getAgentState(self.index).configuration.direction]
-    if reversed_direction in actions:
-      actions.remove(reversed_direction)
-    if len(actions) == 0:
-      return True
-    for a in actions:
-      if not self.takeToEmptyAlley(new_state, a, depth - 1):
-        return False
+    alley = self.analysis.getAlleyCells(nextPos)
+    # An opponent in sight that would send the agent home if met in the
+    # alley makes it not empty; ones it would eat or pass do not
+    myTimer = gameState.getAgentState(self.index).scaredTimer
+    for i in self.getOpponents(gameState):
+      enemy = gameState.getAgentState(i)
+      pos = enemy.getPosition()
+      if pos == None or pos not in alley:
+        continue
+      if gameState.isRed(pos) != self.red:
+        if not enemy.isPacman and enemy.scaredTimer <= 0:
+          return False
+      elif enemy.isPacman:
+        # Moves into the alley to reach it; the agent's timer runs down on each
+        steps = self.analysis.getAlleyDepth(pos) - self.analysis.getAlleyDepth(nextPos) + 1
+        if myTimer - steps + 1 > 0:
+          return False
+    # Carrying food into an alley that reaches home scores on the way
+    if gameState.getAgentState(self.index).numCarrying > 0:
+      for cell in alley:
+        if gameState.isRed(cell) == self.red:
+          return False
     return True
 
   def __init__(self, index):
@@ -188,6 +225,8 @@ class Attacker(EvaluationBasedAgent):
   def registerInitialState(self, gameState):
     CaptureAgent.registerInitialState(self, gameState)
     self.distancer.getMazeDistances()
+    self.analysis = self.getLayoutAnalysis(gameState)
+    self.rollouts = RolloutSimulator(self, gameState)
 
   # Implemente este metodo para controlar o agente (1s max).
   def chooseAction(self, gameState):
@@ -219,10 +258,7 @@ class Attacker(EvaluationBasedAgent):
     fvalues = []
     for a in actions:
       new_state = gameState.generateSuccessor(self.index, a)
-      value = 0
-      for i in range(1,31):
-        value += self.randomSimulation(10, new_state)
-      fvalues.append(value)
+      fvalues.append(self.rollouts.simulate(new_state, ROLLOUT_DEPTH, NUM_ROLLOUTS))
 
     best = max(fvalues)
     ties = filter(lambda x: x[0] == best, zip(fvalues, actions))
@@ -231,6 +267,123 @@ class Attacker(EvaluationBasedAgent):
     #print 'eval time for offensive agent %d: %.4f' % (self.index, time.time() - start)
     return toPlay
  
+class RolloutSimulator:
+  """
+  Plays the random walks of Attacker.randomSimulation over tables made once
+  for the layout: the moves from each cell, which cells are home, and a bit
+  for each cell so the food left is a single int.  Only the walking agent
+  moves, following the capture rules for eating food and capsules, bringing
+  food home and colliding with the opponents it can see.  The walk's end is
+  scored by the Attacker's featuresFor and weightsFor, without any GameState
+  being built on the way.
+
+  Walks choose their moves from the same lists in the same order as
+  randomSimulation, so they use the random numbers the same way.  The one
+  liberty taken is with an agent that dies: the food it carried is put back
+  where the walk ate it, rather than dropped around where it died.
+  """
+  def __init__(self, agent, gameState):
+    walls = gameState.getWalls()
+    self.agent = agent
+    self.index = agent.index
+    self.bits = {}
+    self.moves = {}
+    self.home = set()
+    for cell in walls.asList(False):
+      x, y = cell
+      self.bits[cell] = 1 << (x * walls.height + y)
+      # (action, next cell) for each move but STOP, in getLegalActions order,
+      # without the reverse of the direction the agent faces if that leaves any
+      actions = Actions.getPossibleActions(Configuration(cell, Directions.STOP), walls)
+      moves = [(a, Actions.getSuccessor(cell, a)) for a in actions if a != Directions.STOP]
+      self.moves[cell] = {}
+      for direction in Directions.REVERSE:
+        forward = [move for move in moves if move[0] != Directions.REVERSE[direction]]
+        if len(moves) == 1:
+          forward = moves
+        self.moves[cell][direction] = forward
+      if gameState.isRed(cell) == agent.red:
+        self.home.add(cell)
+    self.walks = 0
+
+  def simulate(self, gameState, depth, count):
+    """
+    Returns the sum of the values of count random walks of depth moves by
+    the agent from gameState.
+    """
+    myState = gameState.getAgentState(self.index)
+    score = self.agent.getScore(gameState)
+    foodList = self.agent.getFood(gameState).asList()
+    food = 0
+    for cell in foodList:
+      food |= self.bits[cell]
+    capsules = self.agent.getCapsules(gameState)
+    # [position, isPacman, scaredTimer, start] of each opponent in sight
+    enemies = []
+    for i in self.agent.getOpponents(gameState):
+      enemy = gameState.getAgentState(i)
+      if enemy.getPosition() != None:
+        enemies.append([enemy.getPosition(), enemy.isPacman, enemy.scaredTimer, enemy.start.pos])
+    start = (myState.getPosition(), myState.configuration.direction, myState.isPacman,
+             myState.scaredTimer, myState.numCarrying, myState.start)
+
+    value = 0
+    for i in range(count):
+      value += self._walk(depth, start, score, foodList, food, capsules, enemies)
+    self.walks += count
+    return value
+
+  def _walk(self, depth, start, score, foodList, food, capsules, enemies):
+    pos, direction, isPacman, scaredTimer, numCarrying, respawn = start
+    home, bits = self.home, self.bits
+    capsules = list(capsules)
+    enemies = [list(enemy) for enemy in enemies]
+    eaten = 0
+    while depth > 0:
+      direction, pos = random.choice(self.moves[pos][direction])
+      depth -= 1
+
+      isPacman = pos not in home
+      if isPacman:
+        bit = bits[pos]
+        if food & bit:
+          food &= ~bit
+          eaten |= bit
+          numCarrying += 1
+        if pos in capsules:
+          capsules.remove(pos)
+          for enemy in enemies:
+            enemy[2] = SCARED_TIME
+      elif numCarrying > 0:
+        score += numCarrying
+        numCarrying = 0
+        eaten = 0
+
+      # Collisions with opponents standing on the same cell
+      died = False
+      for enemy in enemies:
+        if enemy[0] != pos or enemy[1] == isPacman:
+          continue
+        if (isPacman and enemy[2] > 0) or (not isPacman and scaredTimer <= 0):
+          enemy[0], enemy[1], enemy[2] = enemy[3], False, 0
+        else:
+          died = True
+          break
+      if died:
+        food |= eaten
+        eaten = 0
+        numCarrying = 0
+        pos, direction = respawn.pos, respawn.direction
+        isPacman = False
+        scaredTimer = 0
+      elif scaredTimer > 0:
+        scaredTimer -= 1
+
+    foodLeft = [cell for cell in foodList if food & bits[cell]]
+    ghosts = [(enemy[0], enemy[2]) for enemy in enemies if not enemy[1]]
+    features = self.agent.featuresFor(score, pos, isPacman, foodLeft, ghosts)
+    return features * self.agent.weightsFor(pos, ghosts)
+
 class Defender(CaptureAgent):
   "Gera Monte, o agente defensivo."
 
@@ -327,7 +480,7 @@ class Defender(CaptureAgent):
     invaders = filter(lambda x: x.isPacman and x.getPosition() != None, enemies)
     if len(invaders) > 0:
       positions = [agent.getPosition() for agent in invaders]
-      self.target = min(positions, key = lambda x: self.getMazeDistance(mypos, x))
+      self.target = self.distancer.nearest(mypos, positions)[0]
       print 'positions', positions
     # If we can't see an invader, but our pacdots were eaten,
     # we will check the position where the pacdot disappeared.
@@ -19,11 +19,15 @@ import random,util,time,distanceCalculator
 import game
 from util import nearestPoint
 from util import pause
-from capture import noisyDistance
+from capture import noisyDistance, CaptureRules, GameState
 import math
 import hashlib
 import logging
 import argparse
+import cPickle
+import multiprocessing
+from collections import OrderedDict
+from game import BitGrid
 
 ######################
 # Parameters of MCTS #
@@ -31,7 +35,11 @@ import argparse
 
 #MCTS scalar.  Larger scalar will increase exploitation, smaller will increase exploration. 
 SCALAR=1/math.sqrt(2.0)
-NUM_SIM=1    # number of simulation times, at lease 1
+NUM_SIM=None # number of simulation times, at lease 1; None to search until the deadline
+SEARCH_TIME=0.8   # fraction of the move warning time a search may take
+PARALLEL_WORKERS=0   # worker processes searching in parallel; 0 or 1 to search in this process
+WORKER_GRACE=0.1   # seconds past the deadline a worker's answer is waited for
+TRANSPOSITION_TABLE_SIZE=100000   # states whose statistics are shared between nodes; 0 for none
 # REWARD_DISCOUNT=0.8
 REWARD_DISCOUNT=0   # if don't want to use roll out, just turn reward discount into 0
 SIM_LEVEL=1   # level of tree expanding
@@ -163,7 +171,7 @@ class AttackAgent(MCTSAgent):
     # Compute distance to the nearest food
     if len(foodList) > 0: # This should always be True,  but better safe than sorry
       myPos = successor.getAgentState(self.index).getPosition()
-      minDistance = min([self.getMazeDistance(myPos, food) for food in foodList])
+      minDistance = self.distancer.nearest(myPos, foodList)[1]
       features['distanceToFood'] = minDistance
 
     # Compute distance to the nearest ghost
@@ -175,8 +183,7 @@ class AttackAgent(MCTSAgent):
       myPos = successor.getAgentPosition(self.index)
       # myPos = gameState.getAgentPosition(self.index)
       positions = [agent.getPosition() for agent in ghosts]
-      self.target = min(positions, key = lambda x: self.getMazeDistance(myPos, x))
-      self.distanceToGhost = self.getMazeDistance(myPos, self.target)  
+      self.target, self.distanceToGhost = self.distancer.nearest(myPos, positions)
       if self.distanceToGhost < 10:
         features['distanceToGhost'] = self.distanceToGhost
       #print 'Ghost Positions:', positions  # Ghost index: 1, 3
@@ -227,7 +234,21 @@ class DefenseAgent(MCTSAgent):
     self.svalue=0 
     self.smoves=[]
     self.gameState = gameState
-    self.current_node = Node( MState(self.gameState, self.index, self.svalue, self.smoves, self.sturns) )
+    # Every node of the search tree evaluates its moves through this
+    self.evaluator = MoveEvaluator(self)
+    self.current_node = Node( MState(self.gameState, self.index, self.svalue, self.smoves, self.sturns, evaluator=self.evaluator) )
+    # The child chosen last turn, whose subtree the next search starts from
+    self.lastChild = None
+    self.searchTime = SEARCH_TIME * CaptureRules().getMoveWarningTime(self.index)
+    # (simulations, seconds) for each search
+    self.searchStats = []
+    # The ParallelSearch, started at the first search that uses it
+    self.workers = None
+    # Statistics shared by the nodes of states reached by different move orders
+    self.transpositions = None
+    if TRANSPOSITION_TABLE_SIZE > 0:
+      self.transpositions = TranspositionTable(TRANSPOSITION_TABLE_SIZE)
+    self.lastMove = None
     #print '~~~register self.current_node', self.current_node
     self.startPosition = self.current_node.mstate.gameState.getAgentState(self.index).getPosition()
     #print '~~~register Start location', self.startPosition
@@ -251,42 +272,114 @@ class DefenseAgent(MCTSAgent):
     """
     Picks among the actions with the highest Q(s,a).
     """
+    if PARALLEL_WORKERS > 1:
+      return self.runParallelSimulation(gameState)
     return self.runSimulation(self.current_node, gameState, self.index, self.levels, self.numSims)
 
-  def runSimulation(self, current_node, gameState, index, levels=3, numSims=5):
+  def runParallelSimulation(self, gameState):
     """
-    Finds the next successor which is a grid position (location tuple).
+    Root-parallel search: every worker process searches its own tree until
+    the deadline, and the visits and rewards of their root children are
+    added up move by move before the best move is picked.
     """
-    # pause()
-    # You can profile your evaluation time by uncommenting these lines
     start = time.time()
-    
+    deadline = start + self.searchTime
+    if self.workers == None:
+      self.workers = ParallelSearch(self, PARALLEL_WORKERS)
+    asked = len(self.workers.connections)
+    results = self.workers.search(gameState, deadline, self.lastMove)
+    if len(results) == 0:
+      # No worker answered; search here with whatever time is left
+      if asked > 0:
+        logger.warn("agent %d: no search workers answered, searching serially" % self.index)
+      self.lastMove = self.runSimulation(self.current_node, gameState, self.index, self.levels, self.numSims, deadline)
+      return self.lastMove
+
+    merged = Node( MState(gameState, self.index, 0, None, None, self.sturns, self.evaluator) )
+    merged.visits = 0
+    children = {}
+    sims = 0
+    for moveStats, workerSims in results:
+      sims += workerSims
+      for move, visits, reward in moveStats:
+        if move not in children:
+          merged.add_child( MState(None, self.index, 0, None, move, self.sturns-1, self.evaluator) )
+          children[move] = merged.children[-1]
+          children[move].visits = 0
+        children[move].visits += visits
+        children[move].reward += reward
+        merged.visits += visits
+    self.lastMove = BESTCHILD(merged, 0, self.index).mstate.fromMove
+
+    elapsed = time.time() - start
+    self.searchStats.append((sims, elapsed))
+    logger.info("agent %d: %d simulations in %.3fs (%.0f/s) on %d workers" % (self.index, sims, elapsed, sims / max(elapsed, 1e-6), len(results)))
+    return self.lastMove
+
+  def final(self, gameState):
+    if self.workers != None:
+      self.workers.close()
+      self.workers = None
+    CaptureAgent.final(self, gameState)
+
+  def followMove(self, move):
+    "Makes the search after this one start from the root's child for move"
+    self.lastChild = None
+    for child in self.current_node.children:
+      if child.mstate.fromMove == move:
+        self.lastChild = child
+
+  def runSimulation(self, current_node, gameState, index, levels=3, numSims=5, deadline=None):
+    """
+    Searches from gameState until the deadline, searchTime from now by
+    default, or for numSims simulations when that is not None, and returns
+    the move to make.  If the agent got where last turn's move should take
+    it, the search goes on from that move's subtree, so its simulations
+    count again.
+    """
+    start = time.time()
+    if deadline == None:
+      deadline = start + self.searchTime
 
-    #print 'runSim/////////////////////////////////////////////'
     self.gameState = gameState
-    self.index = index  
-    self.current_node = current_node
-
-    value = 0
-    self.current_node.resetNode()
-    self.current_node.mstate.resetMState(self.gameState, index, value)
-
-    ## print 'self.current_node', self.current_node, 'type', type(self.current_node)
-    #print 'Current Location', self.current_node.mstate.gameState.getAgentState(self.index).getPosition(), 'type', type(self.current_node.mstate.gameState.getAgentState(self.index).getPosition())
-    ### This location move!!
     self.index = index
-
-    self.current_node.children = []
+    self.evaluator.newTurn()
+    self.current_node = self.reuseTree(current_node, gameState)
+    visits = self.current_node.visits
 
     l = LEVEL
-    child_node=UCTSEARCH(numSims/(l+1), self.current_node, self.index)
-    #print 'Child Location', child_node.mstate.gameState.getAgentState(self.index).getPosition()
-    #print 'Child_node.mstate.fromMove', child_node.mstate.fromMove
-
-    #print '++++++++++++++++defender eval time for agent %d: %.4f' % (self.index, time.time() - start)
+    if numSims == None:
+      budget = None
+    else:
+      budget = numSims/(l+1)
+    child_node=UCTSEARCH(budget, self.current_node, self.index, deadline, self.transpositions)
+    self.lastChild = child_node
+
+    # Every simulation visits the root once
+    sims = self.current_node.visits - visits
+    elapsed = time.time() - start
+    self.searchStats.append((sims, elapsed))
+    logger.info("agent %d: %d simulations in %.3fs (%.0f/s)" % (self.index, sims, elapsed, sims / max(elapsed, 1e-6)))
+    if self.transpositions != None:
+      logger.info("agent %d: transposition table %s" % (self.index, self.transpositions.getStats()))
 
     return child_node.mstate.fromMove
 
+  def reuseTree(self, root, gameState):
+    """
+    Returns the root to search from: last turn's chosen child, moved onto
+    gameState, if the agent is where that child put it, or else root emptied.
+    """
+    child = self.lastChild
+    myPos = gameState.getAgentPosition(self.index)
+    if child != None and child.mstate.gameState.getAgentPosition(self.index) == myPos:
+      child.setParentNode(None)
+      child.rebase(gameState, self.sturns, self.transpositions)
+      child.mstate.value = 0
+      return child
+    root.resetNode()
+    root.mstate.resetMState(gameState, self.index, 0)
+    return root
 
   def getSuccessor(self, gameState, action):
     """
@@ -402,7 +495,8 @@ class DefenseAgent(MCTSAgent):
     if len(invaders) > 0:
       features['distToHome'] = 0
     else:
-      features['distToHome'] = distanceCalculator.Distancer(gameState.data.layout).getDistance(startPos, myPos)
+      # What a Distancer without maze distances would answer
+      features['distToHome'] = distanceCalculator.manhattanDistance(startPos, myPos)
       # features['distToHome'] = self.getMazeDistance(self.startPosition,myPos)
       # features['distToHome'] = self.getMazeDistance(startPos, myPos)
       # features['distToHome'] = self.getMazeDistance(self.start, myPos)
@@ -419,7 +513,7 @@ class DefenseAgent(MCTSAgent):
     if len(invaders) > 0:
       features['distToCentral'] = 0
     else:
-      features['distToCentral'] = distanceCalculator.Distancer(gameState.data.layout).getDistance(centralPos, myPos)
+      features['distToCentral'] = distanceCalculator.manhattanDistance(centralPos, myPos)
     
 
     features['distToHome'] = 0
@@ -438,13 +532,15 @@ class MState():
   NUM_TURNS = 5
   GOAL = 0
 
-  def __init__(self, gameState, index, value=0, move = None, fromMove = None, turn=NUM_TURNS):  
+  def __init__(self, gameState, index, value=0, move = None, fromMove = None, turn=NUM_TURNS, evaluator=None):  
     self.gameState=gameState
     self.index=index
     self.value=value
     self.turn=turn
     self.move=move
     self.fromMove=fromMove
+    # The MoveEvaluator of the agent searching, shared by the whole tree
+    self.evaluator=evaluator
 
   def setMState(self, gameState, index):
     self.gameState=gameState
@@ -463,6 +559,7 @@ class MState():
     mstate.turn = self.turn
     mstate.move = self.move
     mstate.fromMove = self.fromMove
+    mstate.evaluator = self.evaluator
     return mstate
 
   def getFromMove(self):
@@ -503,12 +600,7 @@ class MState():
           # print 'tried_children.mstate.getMove()', n.mstate.getMove()
           # actions.remove(n.mstate.getMove())  
 
-    da = DefenseAgent(self.index, 0.1)
-    da.registerInitialState(self.gameState.deepCopy())
-    # da.setPosition(self.gameState.getAgentState(self.index).getPosition())
-    
-    nextValues = [da.evaluate(self.gameState, a) for a in actions]
-    # nextValue = da.evaluate(self.gameState, nextmove)
+    nextValues = self.evaluator.evaluateAll(self.gameState, actions)
 
     nextValue = max(nextValues)
     bestActions = [a for a, v in zip(actions, nextValues) if v == nextValue]
@@ -532,7 +624,7 @@ class MState():
     ## print 'Features', nextFeatures
 
     # nextMState = MState(nextGameState, self.index, nextValue, nextmove, nextmove, self.turn-1)
-    nextMState = MState(nextGameState, self.index, nextValue, None, nextmove, self.turn-1)
+    nextMState = MState(nextGameState, self.index, nextValue, None, nextmove, self.turn-1, self.evaluator)
 
     ## print '-------self.move', self.move
     ## print '-------nextGameState', nextGameState.getAgentState(self.index).getPosition()
@@ -562,6 +654,188 @@ class MState():
   
 
 
+class ParallelSearch:
+  """
+  Worker processes for the root-parallel search of one agent.  They are
+  forked once the agent is registered, so each holds its own copy of the
+  agent, with the layout, distances and evaluator it already set up, and
+  keeps its own tree from turn to turn.  Each turn they are sent the state,
+  without its layout, which they already have.  A worker that dies or does
+  not answer in time is dropped, and the search goes on without it.
+  """
+  def __init__(self, agent, workers):
+    self.connections = []
+    self.processes = []
+    for i in range(workers):
+      parentEnd, childEnd = multiprocessing.Pipe()
+      process = multiprocessing.Process(target=_searchWorker, args=(agent, childEnd))
+      process.daemon = True
+      process.start()
+      # Only the worker may hold this end, so its pipe closes if it dies
+      childEnd.close()
+      self.connections.append(parentEnd)
+      self.processes.append(process)
+
+  def search(self, gameState, deadline, lastMove):
+    """
+    Has every worker search from gameState until deadline, after moving
+    its tree on by lastMove, the move made last turn.  Returns a list of
+    ([(move, visits, reward)] for the root's children, simulations) pairs,
+    one for each worker that answered within WORKER_GRACE of the deadline.
+    """
+    state = GameState(gameState)
+    state.data.layout = None
+    payload = cPickle.dumps(state, cPickle.HIGHEST_PROTOCOL)
+    for connection in self.connections[:]:
+      try:
+        connection.send((payload, deadline, random.getrandbits(32), lastMove))
+      except (EOFError, IOError, OSError):
+        self._drop(connection)
+    results = []
+    for connection in self.connections[:]:
+      try:
+        if connection.poll(max(0, deadline + WORKER_GRACE - time.time())):
+          results.append(connection.recv())
+          continue
+      except (EOFError, IOError, OSError):
+        pass
+      # Dead, or too late; a late answer would be read as next turn's
+      logger.warn("dropping a search worker that did not answer")
+      self._drop(connection)
+    return results
+
+  def _drop(self, connection):
+    i = self.connections.index(connection)
+    process = self.processes[i]
+    if process.is_alive():
+      process.terminate()
+    process.join()
+    connection.close()
+    del self.connections[i]
+    del self.processes[i]
+
+  def close(self):
+    for connection in self.connections:
+      try:
+        connection.send(None)
+      except (EOFError, IOError, OSError):
+        pass
+    for process in self.processes:
+      process.join(1)
+      if process.is_alive():
+        process.terminate()
+
+def _searchWorker(agent, connection):
+  "The loop run by each ParallelSearch process"
+  layout = agent.gameState.data.layout
+  while True:
+    task = connection.recv()
+    if task == None:
+      break
+    payload, deadline, seed, lastMove = task
+    random.seed(seed)
+    gameState = cPickle.loads(payload)
+    gameState.data.layout = layout
+    agent.followMove(lastMove)
+    agent.runSimulation(agent.current_node, gameState, agent.index, agent.levels, agent.numSims, deadline)
+    root = agent.current_node
+    moveStats = [(c.mstate.fromMove, c.visits, c.reward) for c in root.children]
+    connection.send((moveStats, agent.searchStats[-1][0]))
+
+class MoveEvaluator:
+  """
+  Evaluates moves for the tree search of one agent, with that agent's own
+  evaluate, so the tree does not build and register a new agent for every
+  expansion.  Values are cached for the rest of the turn by the Zobrist key
+  of the state and the action; newTurn empties the cache.
+  """
+  def __init__(self, agent):
+    self.agent = agent
+    self.values = {}
+    self.hits = 0
+    self.misses = 0
+
+  def newTurn(self):
+    self.values = {}
+
+  def evaluate(self, gameState, action):
+    key = (gameState.data.getZobristKey(), action)
+    if key in self.values:
+      self.hits += 1
+      return self.values[key]
+    self.misses += 1
+    value = self.agent.evaluate(gameState, action)
+    self.values[key] = value
+    return value
+
+  def evaluateAll(self, gameState, actions):
+    return [self.evaluate(gameState, a) for a in actions]
+
+def stateSignature(gameState):
+  """
+  The key of gameState in a TranspositionTable: each agent's position,
+  scared timer and food carried, and the food left as a bitmask.  The
+  directions agents face are left out, so different orders of the same
+  moves reach the same key.
+  """
+  data = gameState.data
+  agents = []
+  for agentState in data.agentStates:
+    conf = agentState.configuration
+    if conf == None:
+      pos = None
+    else:
+      pos = conf.pos
+    agents.append((pos, agentState.scaredTimer, agentState.numCarrying))
+  if isinstance(data.food, BitGrid):
+    food = data.food._bits
+  else:
+    food = data.food.packBits()
+  return (tuple(agents), food)
+
+class TranspositionEntry(object):
+  "Visits and reward shared by every node whose state has one signature"
+  __slots__ = ('visits', 'reward')
+
+  def __init__(self):
+    # Counted from one like a new Node, so fresh entries never divide by zero
+    self.visits = 1
+    self.reward = 0.0
+
+class TranspositionTable:
+  """
+  Maps state signatures to TranspositionEntries, keeping at most maxEntries
+  and dropping the least recently used first.  A node that finds its state
+  already in the table starts from the statistics gathered for it along
+  other move orders, instead of from scratch; transpositions counts those.
+  """
+  def __init__(self, maxEntries):
+    self.maxEntries = maxEntries
+    self.entries = OrderedDict()
+    self.lookups = 0
+    self.transpositions = 0
+    self.evictions = 0
+
+  def lookup(self, signature, count=True):
+    "Returns the entry for signature, adding it if it is new"
+    if count:
+      self.lookups += 1
+    entry = self.entries.pop(signature, None)
+    if entry != None:
+      if count:
+        self.transpositions += 1
+    else:
+      entry = TranspositionEntry()
+      if len(self.entries) >= self.maxEntries:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+    self.entries[signature] = entry
+    return entry
+
+  def getStats(self):
+    return {'entries': len(self.entries), 'lookups': self.lookups,
+            'transpositions': self.transpositions, 'evictions': self.evictions}
+
 class Node():
   def __init__(self, mstate, parent=None):
     self.visits=1
@@ -569,6 +843,8 @@ class Node():
     self.mstate=mstate
     self.children=[]
     self.parent=parent  
+    # The TranspositionEntry of this node's state, if a table is in use
+    self.entry=None
   def add_child(self,child_mstate):
     child=Node(child_mstate,self)
     self.children.append(child)
@@ -580,6 +856,25 @@ class Node():
     self.children=[]
   def setParentNode(self, node):
     self.parent = node
+  def rebase(self, gameState, turn, table=None):
+    """
+    Moves this subtree onto gameState.  Each child's state is made again by
+    its move from its parent's new state, and its value evaluated there;
+    visits and rewards are kept.  Nodes take the table entries of their new
+    states, handing on their own statistics when those are the fuller ones.
+    """
+    self.mstate.gameState = gameState
+    self.mstate.turn = turn
+    self.entry = None
+    if table != None:
+      self.entry = table.lookup(stateSignature(gameState), False)
+      if self.entry.visits < self.visits:
+        self.entry.visits = self.visits
+        self.entry.reward = self.reward
+    for child in self.children:
+      move = child.mstate.fromMove
+      child.mstate.value = self.mstate.evaluator.evaluate(gameState, move)
+      child.rebase(gameState.generateSuccessor(self.mstate.index, move), turn - 1, table)
   def update(self,reward):
     self.reward+=reward
     self.visits+=1
@@ -618,22 +913,33 @@ class Node():
 #     for c in children:
 #       #print c.gameState.getAgentPosition(2)
 
-def UCTSEARCH(budget,root,index):
+def UCTSEARCH(budget,root,index,deadline=None,table=None):
+  """
+  Runs up to budget simulations, any number if it is None, stopping at the
+  time.time() deadline if there is one once at least one has run.  With a
+  TranspositionTable, nodes of the same state share their statistics.
+  """
   #print 'UCTSEARCH'
   ## print 'location', root.mstate.gameState.getAgentPosition(index)
-  for iter in range(budget):
+  if budget == None and deadline == None:
+    raise Exception('UCTSEARCH needs a budget or a deadline')
+  iter = 0
+  while budget == None or iter < budget:
+    if iter > 0 and deadline != None and time.time() >= deadline:
+      break
     if iter%10000==9999:
       logger.info("simulation: %d"%iter)
       logger.info(root)
     ## print 'root', root, 'type(root)', type(root)
-    front=TREEPOLICY(root,index)
+    front=TREEPOLICY(root,index,table)
     reward=DEFAULTPOLICY(front.mstate)
     BACKUP(root,front,reward)
+    iter += 1
   ## print 'root location', root.mstate.gameState.getAgentPosition(index)
   ## print 'c location', BESTCHILD(root,0,index).mstate.gameState.getAgentPosition(index)
   return BESTCHILD(root,0,index)
 
-def TREEPOLICY(node,index):
+def TREEPOLICY(node,index,table=None):
   #print 'TREEPOLICY'
   ## print '^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^root before if', node, 'type(root)', type(node)
 
@@ -643,7 +949,7 @@ def TREEPOLICY(node,index):
       ## print 'terminal()==False'
       if node[0].fully_expanded()==False:  
         ## print 'fully_expanded()==False'
-        return EXPAND(node[0])
+        return EXPAND(node[0],table)
       else:
         node[0]=BESTCHILD(node[0],SCALAR,index)
     return node
@@ -656,13 +962,13 @@ def TREEPOLICY(node,index):
       ## print 'terminal()==False'
       if node.fully_expanded()==False:  
         ## print 'fully_expanded()==False'
-        return EXPAND(node)
+        return EXPAND(node,table)
       else:
         #print 'Fully Expanded'
         node=BESTCHILD(node,SCALAR,index)
     return node
 
-def EXPAND(node):
+def EXPAND(node,table=None):
   #print 'EXPAND'
   # tried_children_mstate=[c.mstate for c in node.children]
   # if tried_children_mstate != []:
@@ -712,6 +1018,8 @@ def EXPAND(node):
   #print 'Until new_mstate not in tried_children_mstate', new_mstate
   node.add_child(new_mstate)
   node.children[-1].setParentNode(node)
+  if table != None:
+    node.children[-1].entry = table.lookup(stateSignature(new_mstate.gameState))
 
   # for child in node.children:
   ##   print 'node.children.mstate', child.mstate
@@ -726,8 +1034,11 @@ def BESTCHILD(node,scalar,index):
   bestchildren=[]
   for c in node.children:
     #print 'c location', c.mstate.gameState.getAgentPosition(index)
-    exploit=c.reward/c.visits
-    explore=math.sqrt(math.log(2*node.visits)/float(c.visits))  
+    stats = c
+    if c.entry != None:
+      stats = c.entry   # shared with the other nodes of the same state
+    exploit=stats.reward/stats.visits
+    explore=math.sqrt(math.log(2*node.visits)/float(stats.visits))  
     score=exploit+scalar*explore
     #print 'score', score, 'bestscore', bestscore
     if score==bestscore:
@@ -758,10 +1069,16 @@ def DEFAULTPOLICY(mstate):
 
 def BACKUP(root,node,reward):
   #print 'BACKUP'
+  updated=set()   # entries already counted, for paths that revisit a state
   while node!=None:
     node.visits+=1
     node.reward+=reward*(REWARD_DISCOUNT**SIM_LEVEL) # discounted reward after several turns of simulation
     node.reward+=node.mstate.reward() # add the root reward and the last reward together
+    if node.entry!=None and node.entry not in updated:
+      updated.add(node.entry)
+      node.entry.visits+=1
+      node.entry.reward+=reward*(REWARD_DISCOUNT**SIM_LEVEL)
+      node.entry.reward+=node.mstate.reward()
 
     node=node.parent
     # node.parent = root